@@ -13,6 +13,14 @@
 # The mrep command is implemented as a command runner task, MrepScan, which runs in the main process,
 # and a BatchTask for the worker processes to count the files and dirs and get stats for the filters.
 # Refer to the output of "xcp help info" for filter expression syntax and examples.
+# With -groupby, each worker also evaluates one expression per file (e.g. owner, or the file's
+# extension) and counts the file in a TreeStats for that key, so a single scan can produce
+# a report per owner or per project without writing a filter line for each one.
+# For each filter, the workers also keep the N largest files, the N oldest files, and the N dirs
+# with the most entries in small fixed-size heaps; these lists are added to the reports.
+# With -sample, only a pseudo-random fraction of the subdirs at each of the top few levels is walked
+# (the run function adds an -exclude filter for the rest), each counted entry is weighted by the inverse
+# of its probability of being walked, and the reports show 95% confidence intervals for the estimates.
 #
 # WARNING
 # Filter expressions will be processed by xcp at runtime using python 'eval'
@@ -26,6 +34,11 @@
 #   # xcp diag -run mrep.py mrep -filters f.txt server:/export/path
 # 3) Find the generated report files (default directory is /tmp):
 #   petefilter.csv  petefilter.html  petefilter.json  rootfilter.csv  rootfilter.html  rootfilter.json
+# 4) Or get one report per owner, keeping at most 500 groups and counting the rest as '(other)':
+#   # xcp diag -run mrep.py mrep -groupby owner -groupmax 500 server:/export/path
+#   Add -groupcsv to write a single combined groupby.csv instead of three files for each owner
+# 5) Or estimate the filter reports by walking 5% of the subdirs at each of the top 3 levels:
+#   # xcp diag -run mrep.py mrep -filters f.txt -sample 0.05 -samplelevels 3 server:/export/path
 #
 # HISTORY
 # August 8, 2019		  Peter Schay		Created
@@ -34,17 +47,26 @@ if __name__ == '__main__':
 	print 'Multi-report (mrep) command usage:'
 	print '# xcp diag -run mrep.py help mrep'
 	print '# xcp diag -run mrep.py mrep <options> -filters <file> <path-to-scan>'
+	print '# xcp diag -run mrep.py mrep <options> -groupby <expression> <path-to-scan>'
 	import sys
 	sys.exit()
 
 # Python imports
 import os
 import io
+import re
+import cgi
 import json
+import math
+import heapq
+import hashlib
+import random
+from itertools import chain
 
 # Modules from the xcp engine
 import rd
 import xcp
+import nfs3
 import scan
 import repo
 import sched
@@ -61,6 +83,35 @@ saveOption = args.String('-saveto', 'directory for reports',
 	arg='local path', default = '/tmp'
 )
 
+groupbyOption = args.String('-groupby', 'one report for each value of a python expression',
+	arg='python eval-ready expression, e.g. owner'
+)
+
+groupMaxOption = args.OptionInfo('-groupmax', 'max number of -groupby reports, including "(other)" for the rest',
+	args.Types.Int, arg='#', default=1000
+)
+
+groupCsvOption = args.OptionInfo('-groupcsv', 'save the -groupby reports in a single csv file')
+
+topOption = args.OptionInfo('-top', 'number of largest, oldest, and biggest dirs to list in each filter report',
+	args.Types.Int, arg='#', default=10
+)
+
+sampleOption = args.String('-sample', 'estimate the reports by walking only this fraction of the subdirs',
+	arg='fraction, e.g. 0.01'
+)
+
+defaultSampleLevels = 3
+sampleLevelsOption = args.OptionInfo('-samplelevels', 'number of dir levels below the root to sample with -sample',
+	args.Types.Int, arg='#', default=defaultSampleLevels
+)
+
+sampleSeedOption = args.OptionInfo('-sampleseed', 'seed to choose the same sample dirs again', args.Types.Int, arg='#')
+
+# Name of the bucket for files whose -groupby key did not fit under -groupmax
+# The keys are str() of the expression's value, so the parentheses keep it apart from a real value like owner 'other'
+otherKey = '(other)'
+
 # Accept all the scan options for the mrep command but hide them in the help
 # Performance, depth, and other options may be useful and some options are not, like -l or -v
 scanOptions = list(scan.scanOptions)
@@ -69,7 +120,8 @@ for opt in scanOptions:
 
 desc = command.Desc(
 	'mrep',
-	[filtersOption, saveOption] + scanOptions,
+	[filtersOption, saveOption, groupbyOption, groupMaxOption, groupCsvOption, topOption,
+		sampleOption, sampleLevelsOption, sampleSeedOption] + scanOptions,
 	'Generate multiple reports from a single scan',
 	npaths=1
 )
@@ -77,23 +129,273 @@ desc = command.Desc(
 # The run function allows this module to be called via xcp diag -run mrep.py
 # Note: a quirk of running it this way is that the log file will be 'xcp.x1.log'
 def run(argv):
-	xcp.xcp(argv)
+	xcp.xcp(addSampleExclude(argv))
+
+# Get the value following an option on the command line, or the default
+def getArg(argv, name, default=None):
+	if name in argv[:-1]:
+		return argv[argv.index(name) + 1]
+	return default
+
+# The scan engine decides which dirs to walk before our batch tasks ever see them,
+# so -sample works by excluding the dirs that are not in the sample.  A dir at depth 1 to -samplelevels
+# is in the sample if a hash of its fileid is below the fraction; dirs deeper than that are always walked.
+# The hash is seeded so that a different sample is taken each run, unless -sampleseed is used;
+# a random seed is added to the command line as -sampleseed, so the reports can say which seed was used.
+hashMultiplier = 2654435761
+hashModulus = 1000003
+
+def addSampleExclude(argv):
+	try:
+		p = float(getArg(argv, str(sampleOption)))
+		levels = int(getArg(argv, str(sampleLevelsOption), defaultSampleLevels))
+		seed = int(getArg(argv, str(sampleSeedOption), random.randrange(hashModulus)))
+	except (TypeError, ValueError):
+		# No -sample option, or a bad value which MrepScan will report
+		return argv
+	expr = 'type == d and 1 <= depth <= {} and (fileid * {} + {}) % {} >= {}'.format(
+		levels, hashMultiplier, seed, hashModulus, int(p * hashModulus))
+	argv = list(argv)
+	if str(sampleSeedOption) not in argv[:-1]:
+		argv[-1:-1] = [str(sampleSeedOption), str(seed)]
+	if '-exclude' in argv[:-1]:
+		i = argv.index('-exclude') + 1
+		argv[i] = '({}) or ({})'.format(argv[i], expr)
+	else:
+		argv[-1:-1] = ['-exclude', expr]
+	return argv
+
+# Weights for the entries found by a sampled scan
+# The root is depth 0 and dirs at depths 1 to levels were each walked with probability p,
+# so an entry whose parent is at depth d was found with probability p**min(d, levels)
+# Entries are grouped into clusters by their top level dir, which is the unit of the first level of sampling;
+# the variance is estimated from the cluster totals, and entries directly in the root have no variance
+class Sample(object):
+	def __init__(self, p, levels, seed, rootFileid):
+		self.p = p
+		self.levels = levels
+		self.seed = seed
+		self.rootFileid = rootFileid
+
+	# The depth of dir d below the root and the name of its top level dir, from the parent chain
+	# rather than the path, which is expensive to build; memo has the dirs already seen in the batch
+	def locate(self, d, memo):
+		chain = []
+		while d is not None and id(d) not in memo:
+			if d.a.fileid == self.rootFileid:
+				memo[id(d)] = (0, None)
+				break
+			chain.append(d)
+			d = d.parent
+		depth, top = memo[id(d)] if d is not None else (-1, None)
+		for d in reversed(chain):
+			depth += 1
+			if depth == 1:
+				top = d.name
+			memo[id(d)] = (depth, top)
+		return depth, top
+
+	def weigh(self, x, memo):
+		if x.a.type == nfs3.DIR:
+			sampledLevels, top = self.locate(x, memo)
+		else:
+			sampledLevels, top = self.locate(x.parent, memo)
+		sampledLevels = min(sampledLevels, self.levels)
+		w = 1.0 / self.p ** max(sampledLevels, 0)
+		if sampledLevels < 1:
+			return w, None
+		return w, top
+
+	# Each cluster is [entries, bytes] for the weighted entries and their size
+	def add(self, clusters, c, w, x):
+		cl = clusters.setdefault(c, [0.0, 0.0])
+		cl[0] += w
+		if x.a.type != nfs3.DIR:
+			cl[1] += w * x.a.size
+
+	# Return the estimates and their 95% confidence intervals, using the variance estimator for
+	# Bernoulli sampling of the top level clusters.  When deeper levels are sampled too, the cluster totals
+	# are themselves estimates; leaving out the (1 - p) correction then keeps the interval conservative
+	def estimates(self, clusters):
+		fpc = (1 - self.p) if self.levels == 1 else 1
+		est = {}
+		for i, name in enumerate(['entries', 'size']):
+			total = sum(cl[i] for cl in clusters.values())
+			var = sum(fpc * cl[i] ** 2 for c, cl in clusters.items() if c is not None)
+			half = 1.96 * math.sqrt(var)
+			est[name] = [int(round(total)), int(max(0, round(total - half))), int(round(total + half))]
+		return est
+
+def mergeClusters(clusters, other):
+	for c, (n, size) in other.items():
+		cl = clusters.setdefault(c, [0.0, 0.0])
+		cl[0] += n
+		cl[1] += size
+
+def formatSample(sample, est, html=False):
+	title = 'Sampled estimates (fraction {}, {} levels, seed {}, 95% confidence)'.format(sample.p, sample.levels, sample.seed)
+	if html:
+		lines = ['<h3>{}</h3>'.format(title), '<table><tr><th></th><th>estimate</th><th>low</th><th>high</th></tr>']
+		for name in sorted(est):
+			lines.append('<tr><td>{}</td><td>{}</td><td>{}</td><td>{}</td></tr>'.format(name, *est[name]))
+		lines.append('</table>')
+	else:
+		lines = ['', '{},estimate,low,high'.format(title)]
+		for name in sorted(est):
+			lines.append('{},{},{},{}'.format(name, *est[name]))
+	return '\n'.join(lines) + '\n'
+
+# Evaluates the -groupby expression for each file to get the name of its group
+# The expression is compiled by xfilter just like a filter, but its value is the key instead of True/False,
+# so it needs an xfilter that can return the value (check only returns whether it matched)
+class GroupBy(object):
+	def __init__(self, source, osCache, maxKeys):
+		self.xf = xfilter.Filter(source, osCache, name='groupby')
+		if not hasattr(self.xf, 'eval'):
+			raise sched.ShortError('this version of xcp cannot get the value of a {} expression'.format(groupbyOption))
+		self.source = source
+		self.maxKeys = maxKeys
+
+	# Evaluates the expression once in the main process, so an expression that can't work
+	# is an error now instead of putting every file in the "other" bucket
+	def validate(self, x):
+		self.xf.eval(x)
+
+	def key(self, x):
+		try:
+			k = self.xf.eval(x)
+		except AttributeError:
+			# For example, an expression on an attribute the file does not have
+			return otherKey
+		if k is None:
+			return otherKey
+		return str(k)
+
+	# The key to use in a dict of groups for key k: k itself, or the "other" bucket if there are already too many keys
+	# The other bucket counts toward maxKeys, so there are at most maxKeys - 1 real keys
+	def bucket(self, groups, k):
+		if k not in groups and len(groups) - (otherKey in groups) >= self.maxKeys - 1:
+			return otherKey
+		return k
+
+	# Add the stats for key k to the dict of TreeStats, or to the "other" bucket;
+	# this keeps memory bounded no matter how many distinct keys
+	def add(self, groups, k, ts):
+		k = self.bucket(groups, k)
+		if k not in groups:
+			groups[k] = rd.TreeStats()
+		groups[k].update(ts)
+
+# The TopN lists kept for each filter: the name in the reports, a title, and a function to get the value
+# The value for age is the number of seconds since the last modification, when the scan started
+# The entries of a dir are counted from the batches, where they are the files and dirs whose parent it is
+# (the dir itself is usually in an earlier batch), so entries has no function; see dirEntries
+topMetrics = [
+	('size', 'Largest files', lambda x, when: x.a.size if x.a.type != nfs3.DIR else None),
+	('age', 'Oldest files', lambda x, when: when - x.a.mtime if x.a.type != nfs3.DIR else None),
+	('entries', 'Dirs with the most entries', None),
+]
+
+# The parent dirs of the entries in a batch, with the number of entries in the batch for each one
+def dirEntries(batch):
+	parents = {}
+	for x in chain(batch.files, batch.dirs):
+		if x.parent is not None:
+			parents.setdefault(id(x.parent), [x.parent, 0])[1] += 1
+	return parents.values()
+
+# Fixed-size min-heap of the N biggest (value, path) tuples seen so far
+# The smallest value is always at heap[0] so it is cheap to check if a new value makes the cut;
+# the path, which is expensive to build, is only computed for files that do.
+# Only the python list of tuples is used so it can be pickled back to the main process
+# With sums, the values for the same path from different batches are added up when the lists are merged;
+# a dir whose entries are split over several batches only gets the counts from the batches where it made
+# the list, so its count can be low
+class TopN(object):
+	def __init__(self, n, sums=False):
+		self.n = n
+		self.sums = sums
+		self.heap = []
+
+	def add(self, value, x):
+		if value is None:
+			return
+		if len(self.heap) < self.n:
+			heapq.heappush(self.heap, (value, x.getPath()))
+		elif value > self.heap[0][0]:
+			heapq.heapreplace(self.heap, (value, x.getPath()))
+
+	def update(self, other):
+		for t in other.heap:
+			if self.sums:
+				i = next((i for i, (_, path) in enumerate(self.heap) if path == t[1]), None)
+				if i is not None:
+					self.heap[i] = (self.heap[i][0] + t[0], t[1])
+					heapq.heapify(self.heap)
+					continue
+			if len(self.heap) < self.n:
+				heapq.heappush(self.heap, t)
+			elif t > self.heap[0]:
+				heapq.heapreplace(self.heap, t)
+
+	def sorted(self):
+		return sorted(self.heap, reverse=True)
+
+# Return a TopN for each metric, or none at all for -top 0
+def newTops(n):
+	if not n:
+		return []
+	return [TopN(n, sums=value is None) for _, _, value in topMetrics]
+
+# Format the top lists for the csv report, or the html report, as text to add at the end
+def formatTops(tops, html=False):
+	lines = []
+	for (name, title, _), top in zip(topMetrics, tops):
+		if html:
+			lines.append('<h3>{}</h3>'.format(title))
+			lines.append('<table><tr><th>{}</th><th>path</th></tr>'.format(name))
+			for value, path in top.sorted():
+				lines.append('<tr><td>{}</td><td>{}</td></tr>'.format(value, cgi.escape(path)))
+			lines.append('</table>')
+		else:
+			lines.append('')
+			lines.append('{},{}'.format(title, name))
+			for value, path in top.sorted():
+				lines.append('"{}",{}'.format(path.replace('"', '""'), value))
+	return '\n'.join(lines) + '\n'
+
+# Turn the group keys into names that can be used in report file names
+# A key that had to be changed, or whose name is already used, gets a short hash of the key so the names are unique
+def reportNames(keys):
+	names = {}
+	used = set()
+	for k in sorted(keys):
+		name = re.sub(r'[^A-Za-z0-9_.@+-]', '_', k)
+		if not name or name != k or name in used:
+			name = '{}-{}'.format(name, hashlib.md5(k).hexdigest()[:8])
+		used.add(name)
+		names[k] = name
+	return names
 
 class MrepScan(command.Runner):
 	def gRun(self, cmd, catalog):
 		if cmd.options.chose('-id'):
 			raise(sched.ShortError('multi-report does not support offline scanning'))
 
-		# The filters option is required
-		# It's a file with one line per filter
-		if not cmd.options.chose(filtersOption):
-			raise(sched.ShortError('missing {} option'.format(filtersOption)))
+		# At least one of the filters or groupby options is required
+		# The filters option is a file with one line per filter
+		if not cmd.options.chose(filtersOption) and not cmd.options.chose(groupbyOption):
+			raise(sched.ShortError('missing {} or {} option'.format(filtersOption, groupbyOption)))
+
+		if cmd.get(topOption) < 0:
+			raise sched.ShortError('{} must be 0 or more'.format(topOption))
 
 		# Parse the filters and tack them onto the options,
 		# which will be available in our custom BatchTask
 		self.treeStatsList = []
+		self.topsList = []
 		cmd.options.filters = []
-		for s in cmd.get(filtersOption).splitlines():
+		for s in (cmd.get(filtersOption) or '').splitlines():
 			if not s:
 				continue
 			name, t = s.split(':', 1)
@@ -104,6 +406,35 @@ class MrepScan(command.Runner):
 			# Create a TreeStats object here in the main process 
 			# to merge the results for this filter from the child batches
 			self.treeStatsList.append(rd.TreeStats())
+			self.topsList.append(newTops(cmd.get(topOption)))
+
+		# The sampling weights also go into the options for the BatchTask
+		# The clustersList has the weighted totals per top level dir for each filter
+		cmd.options.sample = None
+		self.clustersList = [{} for _ in cmd.options.filters]
+		if cmd.options.chose(sampleOption):
+			try:
+				p = float(cmd.get(sampleOption))
+			except ValueError:
+				p = 0
+			if not 0 < p <= 1:
+				raise sched.ShortError('{} must be a fraction between 0 and 1'.format(sampleOption))
+			if not cmd.options.chose('-exclude'):
+				raise sched.ShortError('{} needs the -exclude option; run mrep with "xcp diag -run mrep.py"'.format(sampleOption))
+			cmd.options.sample = Sample(p, cmd.get(sampleLevelsOption), cmd.get(sampleSeedOption), cmd.roots[0].a.fileid)
+
+		# The groupby expression also goes into the options for the BatchTask
+		# The groups dict maps each key to its merged TreeStats
+		cmd.options.groupby = None
+		self.groups = {}
+		if cmd.options.chose(groupbyOption):
+			try:
+				cmd.options.groupby = GroupBy(cmd.get(groupbyOption), self.engine.osCache, cmd.get(groupMaxOption))
+				cmd.options.groupby.validate(cmd.roots[0])
+			except sched.ShortError:
+				raise
+			except Exception as e:
+				raise sched.ShortError('Error in groupby expression <{}>: {}'.format(cmd.get(groupbyOption), e))
 
 		# Allow the -newid option to create an offline index in the catalog
 		index = None
@@ -119,52 +450,148 @@ class MrepScan(command.Runner):
 		# Run the actual scan and wait for it to complete
 		scanTree = self.results = yield (scan.ScanTree(cmd.roots[0], index=index, hooks=hooks), None)
 
+		# The weighted counts from the batches are added up unrounded, and only rounded here
+		if cmd.options.sample:
+			for ts in self.treeStatsList + self.groups.values():
+				roundStats(ts)
+
 		# Now we have the list of TreeStats for each filter and can generate reports
 		os.write(2, 'Generating reports for {} filters and saving in {}\n'.format(
 			len(cmd.options.filters), cmd.get(saveOption)))
 
 		xcpInfo = repo.newXFInfo(xcp._prog, xcp._version)
-		for xf, ts in zip(cmd.options.filters, self.treeStatsList):
-			# We have the filter and the stats
-			# Use a Tree to get the json and fill in some metadata gaps for the reports
-			tree = rd.Tree()
-			tree.actions = rd.Actions()
-			tree.stats = ts.stats
-			tree.treeStats = ts
-			# The treestats are just from the files and dirs in the batches;
-			# copy any additional scan info that should also be in the reports
-			ts.stats[rd.Stats.UnreadableDirs] = scanTree.stats[rd.Stats.UnreadableDirs]
-			ts.stats[rd.Stats.UnreadableFiles] = scanTree.stats[rd.Stats.UnreadableFiles]
-			treeInfo = tree.getJsonInfo(cmd.options)
-			treeInfo['xcp'] = xcpInfo
-			treeInfo['source'] = str(cmd.source)
-			# Use 'command' in the report to describe the scan command *and* this particular filter
-			# so the filter details will show up in the individual reports.  The comma at
-			# the end is just to make the line look better in the html report 
+		for xf, ts, tops, clusters in zip(cmd.options.filters, self.treeStatsList, self.topsList, self.clustersList):
 			# Note: xf.source is the filter expression, vs cmd.source which is a path
-			treeInfo['command'] = '{}, {}, {}, '.format(cmd, xf.name, xf.source)
+			treeInfo = self.getTreeInfo(cmd, scanTree, xcpInfo, ts, xf.name, xf.source)
+			treeInfo['top'] = {name: top.sorted() for (name, _, _), top in zip(topMetrics, tops)}
+			sections = [lambda html, tops=tops: formatTops(tops, html=html)]
+			if cmd.options.sample:
+				sample = cmd.options.sample
+				est = sample.estimates(clusters)
+				treeInfo['sample'] = {'fraction': sample.p, 'levels': sample.levels, 'seed': sample.seed, 'estimates': est}
+				sections.append(lambda html, est=est: formatSample(sample, est, html=html))
+			self.saveReports(cmd, xcpInfo, treeInfo, xf.name, sections=sections)
+
+		if not cmd.options.groupby:
+			return
+
+		os.write(2, 'Generating reports for {} groups and saving in {}\n'.format(
+			len(self.groups), cmd.get(saveOption)))
+
+		if cmd.options.chose(groupCsvOption):
+			# One csv for all the groups; each row of each group's csv report starts with the key
+			path = os.path.join(cmd.get(saveOption), 'groupby.csv')
+			with open(path, 'w') as outf:
+				for k in sorted(self.groups):
+					treeInfo = self.getTreeInfo(cmd, scanTree, xcpInfo, self.groups[k], k, cmd.options.groupby.source)
+					for line in report.getReport(xcpInfo, treeInfo, filters=True, csv=True).splitlines():
+						outf.write('"{}",{}\n'.format(k.replace('"', '""'), line))
+			return
+
+		names = reportNames(self.groups)
+		for k in sorted(self.groups):
+			treeInfo = self.getTreeInfo(cmd, scanTree, xcpInfo, self.groups[k], k, cmd.options.groupby.source)
+			self.saveReports(cmd, xcpInfo, treeInfo, 'groupby-' + names[k])
+
+	def getTreeInfo(self, cmd, scanTree, xcpInfo, ts, name, source):
+		# We have the filter or group and the stats
+		# Use a Tree to get the json and fill in some metadata gaps for the reports
+		tree = rd.Tree()
+		tree.actions = rd.Actions()
+		tree.stats = ts.stats
+		tree.treeStats = ts
+		# The treestats are just from the files and dirs in the batches;
+		# copy any additional scan info that should also be in the reports
+		ts.stats[rd.Stats.UnreadableDirs] = scanTree.stats[rd.Stats.UnreadableDirs]
+		ts.stats[rd.Stats.UnreadableFiles] = scanTree.stats[rd.Stats.UnreadableFiles]
+		treeInfo = tree.getJsonInfo(cmd.options)
+		treeInfo['xcp'] = xcpInfo
+		treeInfo['source'] = str(cmd.source)
+		# Use 'command' in the report to describe the scan command *and* this particular filter
+		# so the filter details will show up in the individual reports.  The comma at
+		# the end is just to make the line look better in the html report 
+		treeInfo['command'] = '{}, {}, {}, '.format(cmd, name, source)
+		return treeInfo
 
-			# Using json.dumps would be simpler but json.dump handles unicode better
-			jsonData = io.BytesIO()
-			json.dump(treeInfo, jsonData)
+	def saveReports(self, cmd, xcpInfo, treeInfo, name, sections=[]):
+		# Using json.dumps would be simpler but json.dump handles unicode better
+		jsonData = io.BytesIO()
+		json.dump(treeInfo, jsonData)
 
-			for ext, data in [
-				('html', report.getReport(xcpInfo, treeInfo, filters=True, html=True)),
-				('csv', report.getReport(xcpInfo, treeInfo, filters=True, csv=True)),
-				('json', jsonData.getvalue()),
-			]:
-				path = os.path.join(cmd.get(saveOption), xf.name)
-				with open('{}.{}'.format(path, ext), 'w') as outf:
-					outf.write(data)
+		html = report.getReport(xcpInfo, treeInfo, filters=True, html=True)
+		csv = report.getReport(xcpInfo, treeInfo, filters=True, csv=True)
+		# The report module doesn't know about the top lists or the sample estimates, so add them at the end
+		for section in sections:
+			i = html.rfind('</body>')
+			if i < 0:
+				i = len(html)
+			html = html[:i] + section(html=True) + html[i:]
+			csv = csv + section(html=False)
 
-			# Uncomment this to print a human-readable report on the console
-			#print '== {} =='.format(treeInfo['command'])
-			#print report.getReport(xcpInfo, treeInfo, filters=True)
+		for ext, data in [
+			('html', html),
+			('csv', csv),
+			('json', jsonData.getvalue()),
+		]:
+			path = os.path.join(cmd.get(saveOption), name)
+			with open('{}.{}'.format(path, ext), 'w') as outf:
+				outf.write(data)
+
+		# Uncomment this to print a human-readable report on the console
+		#print '== {} =='.format(treeInfo['command'])
+		#print report.getReport(xcpInfo, treeInfo, filters=True)
 
 	# For each completed batch, the xcp scan engine will call this function in the main process
 	def finishedBatch(self, batch, batchResult, actions):
 		for ts, brts in zip(self.treeStatsList, batchResult.treeStatsList):
 			ts.update(brts)
+		for tops, brtops in zip(self.topsList, batchResult.topsList):
+			for top, brtop in zip(tops, brtops):
+				top.update(brtop)
+		for clusters, brclusters in zip(self.clustersList, batchResult.clustersList):
+			mergeClusters(clusters, brclusters)
+		for k, brts in batchResult.groups.items():
+			self.engine.options.groupby.add(self.groups, k, brts)
+
+# Count the files and dirs into a TreeStats and save the histogram table counts in the treestats object's
+# stats counter.  This is because the tables have cython fields and at the time cython extension types
+# were not picklable, so the stats are used to retrieve the info back in the main process
+def getTreeStats(files, dirs, when):
+	ts = rd.TreeStats()
+	ts.count(files, when)
+	ts.count(dirs, when)
+	for table in ts.tables:
+		table.save(ts.stats)
+	return ts
+
+# Like getTreeStats, for a sampled scan; each weights entry is (weight, cluster) for the same entry in xs
+# Only the stats that are counts can be scaled by the weights; the others, like maxima, are kept as counted.
+# A stat is a count if it doubles when every entry is counted twice.  The entries with the same weight
+# are counted together and then the counts are scaled by the weight; they are left as floats so that
+# the main process can add them up and round them once, with roundStats.
+# Also returns the weighted totals per cluster for the confidence intervals
+def getSampledTreeStats(xs, weights, when, sample):
+	byWeight = {}
+	clusters = {}
+	for x, (w, c) in zip(xs, weights):
+		byWeight.setdefault(w, []).append(x)
+		sample.add(clusters, c, w, x)
+	ts = rd.TreeStats()
+	ts.stats.update(getTreeStats(xs, [], when).stats)
+	doubled = getTreeStats(xs + xs, [], when).stats
+	counts = set(k for k, v in ts.stats.items() if v and doubled[k] == 2 * v)
+	for k in counts:
+		ts.stats[k] = 0.0
+	for w, group in byWeight.items():
+		for k, v in getTreeStats(group, [], when).stats.items():
+			if k in counts:
+				ts.stats[k] += v * w
+	return ts, clusters
+
+def roundStats(ts):
+	for k, v in ts.stats.items():
+		if isinstance(v, float):
+			ts.stats[k] = int(round(v))
 
 # Each BatchTask runs in a worker process which sends the results back to the main scanner
 class BatchTask(sched.SimpleTask):
@@ -172,20 +599,56 @@ class BatchTask(sched.SimpleTask):
 		# For this batch of scanned files and dirs, get the stats for each filter
 		# Different filters can count or exclude different files and dirs
 		batchResult.treeStatsList = []
+		batchResult.topsList = []
+		batchResult.clustersList = []
+		when = batch.tree.when
+		sample = self.engine.options.sample
+		if sample:
+			# Get the weight of each entry just once for all the filters
+			memo = {}
+			weights = {id(x): sample.weigh(x, memo) for x in chain(batch.files, batch.dirs)}
+			batchWeight = sum(w for w, _ in weights.values())
+		parents = dirEntries(batch) if self.engine.options.get(topOption) else []
+
 		for f in self.engine.options.filters:
-			ts = rd.TreeStats()
 			files = filter(f.check, batch.files)
 			dirs = filter(f.check, batch.dirs)
-			ts.stats[rd.Stats.NotMatched] = (len(batch.files) + len(batch.dirs)) - (len(files) + len(dirs))
-			ts.count(files, batch.tree.when)
-			ts.count(dirs, batch.tree.when)
+			if sample:
+				xs = files + dirs
+				ts, clusters = getSampledTreeStats(xs, [weights[id(x)] for x in xs], when, sample)
+				ts.stats[rd.Stats.NotMatched] = batchWeight - sum(weights[id(x)][0] for x in xs)
+				batchResult.clustersList.append(clusters)
+			else:
+				ts = getTreeStats(files, dirs, when)
+				ts.stats[rd.Stats.NotMatched] = (len(batch.files) + len(batch.dirs)) - (len(files) + len(dirs))
 			batchResult.treeStatsList.append(ts)
 
-			# Save the histogram table counts in the treestats object's stats counter
-			# This is because the tables have cython fields and at the time cython extension types
-			# were not picklable, so the stats are used to retrieve the info back in the main process
-			for table in ts.tables:
-				table.save(ts.stats)
+			# Only the top N for each metric are kept, however big the batch is
+			tops = newTops(self.engine.options.get(topOption))
+			for (_, _, value), top in zip(topMetrics, tops):
+				if value:
+					for x in chain(files, dirs):
+						top.add(value(x, when), x)
+				else:
+					for d, n in parents:
+						if f.check(d):
+							top.add(n, d)
+			batchResult.topsList.append(tops)
+
+		# Compute the groupby key once per file and dir and count it in that key's stats
+		# The number of keys is capped here too so a batch result can't get too big
+		batchResult.groups = {}
+		groupby = self.engine.options.groupby
+		if groupby:
+			members = {}
+			for x in chain(batch.files, batch.dirs):
+				k = groupby.bucket(members, groupby.key(x))
+				members.setdefault(k, []).append(x)
+			for k, xs in members.items():
+				if sample:
+					batchResult.groups[k], _ = getSampledTreeStats(xs, [weights[id(x)] for x in xs], when, sample)
+				else:
+					batchResult.groups[k] = getTreeStats(xs, [], when)
 
 		# This task does not do any IO so it does not have any yields
 		# Add the unreachable yield just to make this function a generator (an xcp coroutine task)
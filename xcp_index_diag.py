@@ -34,10 +34,38 @@
 # - Run all 3 steps and replace the index and remove (actually just rename) the renames file
 # xcp diag -run xcp_index_diag.py indexdiag -id src -rebuild -replace
 #
+# - Diagnose and locate in a single pass through the index (and rebuild in a second pass)
+# xcp diag -run xcp_index_diag.py indexdiag -id src -onepass [-rebuild [-replace]]
+#
+# - Validate the ancestry of every batch, e.g. after a rebuild
+# xcp diag -run xcp_index_diag.py indexdiag -id src -validate [-maxfail #]
+#
+# - Profile the index to choose the -ibatch and -batch sizes (reads the index only)
+# xcp diag -run xcp_index_diag.py indexdiag -id src -stats [-ibatch #]
+#
+# - Compact an index: merge small batches up to the -ibatch size, drop ancestry that no file or dir
+#   in the batch needs, optionally recompress, and replace the index (keeping a .ORIG backup)
+# xcp diag -run xcp_index_diag.py indexcompact -id src [-ibatch #] [-zlevel #] -replace
+#
+# - Continue a rebuild that failed, e.g. after losing the NFS connection, from its last checkpoint
+# xcp diag -run xcp_index_diag.py indexdiag -id src -rebuild -continue [-replace]
+#
+# - Write a dir handle map (the .fhmap sidecar) with the rebuilt or compacted index,
+#   and then find which batches of the index have a dir and its ancestors
+# xcp diag -run xcp_index_diag.py indexcompact -id src -fhmap -replace
+# xcp diag -run xcp_index_diag.py indexdiag -id src -lookup <fh in hex>
+#
+# - Diff the index against an older copy of it in the same catalog dir, e.g. the .ORIG backup
+#   or a copy saved before a sync, without looking at the source
+# xcp diag -run xcp_index_diag.py indexdiff -id src -old <index file name> [-out <local path>]
+#
+# With -onepass, the first pass also sends back every dir's index tuple, which go in a local store like the
+# located ancestry, and the missing ancestry is resolved from the store at the end of the pass instead of in a
+# Locating pass.  This needs local disk space for every dir in the index, but it saves reading the whole index again.
 #
 # NOTES
 # All three phases rely on the index reader which consolidates small batches into bigger ones using Multibatch
-# After a successful rebuild, run the diagnose phase again to make sure the new batches are not missing ancestry
+# After a successful rebuild, run -validate to make sure the new batches are not missing ancestry
 # The point of the renames file is that it contains the latest info which the last sync discovered
 # after building the index, so it always takes precedence - dirs discovered to have been moved or renamed
 # might have been indexed with the old info.  After this rebuild the renames are no longer needed because the
@@ -61,16 +89,262 @@ import parseargs as args
 from itertools import chain
 import cPickle
 import zlib
+import os
+import mmap
+import struct
+import hashlib
+import time
+import heapq
+import copy
+from collections import Counter
 
 def run(argv):
 	xcp.xcp(argv)
 
 rebuildOption = args.OptionInfo('-rebuild', 'create new index')
 replaceOption = args.OptionInfo('-replace', 'replace original index after rebuilding it')
+onePassOption = args.OptionInfo('-onepass', 'diagnose and locate missing ancestry in one pass through the index')
+validateOption = args.OptionInfo('-validate', 'check that the ancestry of every entry in each batch reaches the root')
+maxFailuresOption = args.OptionInfo('-maxfail', 'with -validate, stop after this many failed batches (0 for no limit)', args.Types.Int,
+	arg='#', default=10)
+statsOption = args.OptionInfo('-stats', 'profile the index batch sizes, ancestry, compression and decode times')
+continueOption = args.OptionInfo('-continue', 'continue after the last checkpoint of a failed run')
+workDirOption = args.OptionInfo('-workdir', 'local directory for the located ancestry files', args.Types.String,
+	arg='local path', default='/tmp')
+maxPendOption = args.OptionInfo('-maxpend', 'max writes in flight to the rebuilt index', args.Types.Int,
+	arg='# of requests', default=16)
+readMemOption = args.OptionInfo('-readmem', 'memory budget for multibatches being read and processed', args.Types.Int,
+	arg='MiB', default=1024)
+fhMapOption = args.OptionInfo('-fhmap', 'also write a map of dir handles to the batches of the new index')
+lookupOption = args.OptionInfo('-lookup', 'use the fh map to find the batches with a dir and its ancestors', args.Types.String,
+	arg='fh in hex')
+zlevelOption = args.OptionInfo('-zlevel', 'zlib compression level for the compacted index', args.Types.Int, arg='0-9')
 tryMissingOption = args.OptionInfo('-trymissing', 'test code by diagnosing dirs as missing even if they are not', hidden=True)
 
+# Seconds between checkpoints of the rebuild
+checkpointInterval = 60
+
 # These are supposed to display during the index scan phases, for big indexes
-Stats = ["missing", "located", "gotAncestry"]
+Stats = ["missing", "loops", "located", "gotAncestry", "injected", "trimmed", "validated", "broken",
+	"busy", "idle", "queued", "credits"]
+
+#
+# A dict-like map of dir handles to index tuples, kept in two local files instead of in memory
+# The .tbl file is an open-addressing hash table of fixed-width slots: the md5 of the handle and
+# the offset of its record in the .dat file, where each record is the length and pickle of (fh, tuple).
+# Both files are memory-mapped, so the batch tasks forked by idx.ProcessBatches read the same pages
+# as the main process; pickling a store only sends the path, and the child maps the files itself.
+# Only the main process adds entries.  A child may miss entries added after it mapped the table,
+# which is fine because the tasks only look up entries added by the previous phases.
+class AncestryStore(object):
+	slot = struct.Struct('<16sQ')
+	reclen = struct.Struct('<I')
+	magic = 'XCPANC01'
+
+	def __init__(self, path, nslots=1<<16):
+		self.path = path
+		self.count = 0
+		self.nslots = nslots
+		with open(path + '.tbl', 'wb') as f:
+			f.truncate(nslots * self.slot.size)
+		with open(path + '.dat', 'wb') as f:
+			f.write(self.magic)
+		self.open(writable=True)
+
+	# Open the files of an existing store, e.g. from a checkpoint
+	@classmethod
+	def load(cls, path, count, nslots):
+		store = cls.__new__(cls)
+		store.path = path
+		store.count = count
+		store.nslots = nslots
+		store.open(writable=True)
+		return store
+
+	def open(self, writable=False):
+		self.writable = writable
+		self.tf = open(self.path + '.tbl', writable and 'r+b' or 'rb')
+		self.table = mmap.mmap(self.tf.fileno(), 0, access=writable and mmap.ACCESS_WRITE or mmap.ACCESS_READ)
+		self.df = open(self.path + '.dat', writable and 'r+b' or 'rb')
+		self.dsize = os.fstat(self.df.fileno()).st_size
+		self.data = mmap.mmap(self.df.fileno(), 0, access=mmap.ACCESS_READ)
+
+	def close(self):
+		self.table.close()
+		self.data.close()
+		self.tf.close()
+		self.df.close()
+
+	def remove(self):
+		self.close()
+		os.remove(self.path + '.tbl')
+		os.remove(self.path + '.dat')
+
+	def __getstate__(self):
+		return (self.path, self.count, self.nslots)
+
+	def __setstate__(self, state):
+		self.path, self.count, self.nslots = state
+		self.open()
+
+	def record(self, offset):
+		if offset + self.reclen.size > len(self.data):
+			# The main process appended more records since the data file was mapped
+			self.data.close()
+			self.data = mmap.mmap(self.df.fileno(), 0, access=mmap.ACCESS_READ)
+		n, = self.reclen.unpack_from(self.data, offset)
+		start = offset + self.reclen.size
+		return cPickle.loads(self.data[start:start + n])
+
+	# Return the slot number for fh and the offset of its record, which is 0 if it's not in the store
+	def find(self, fh):
+		key = hashlib.md5(fh).digest()
+		i = struct.unpack_from('<Q', key)[0] % self.nslots
+		while True:
+			k, offset = self.slot.unpack_from(self.table, i * self.slot.size)
+			if not offset:
+				return i, 0
+			if k == key and self.record(offset)[0] == fh:
+				return i, offset
+			i = (i + 1) % self.nslots
+
+	def __contains__(self, fh):
+		return self.find(fh)[1] != 0
+
+	def __getitem__(self, fh):
+		offset = self.find(fh)[1]
+		if not offset:
+			raise KeyError(fh)
+		return self.record(offset)[1]
+
+	def get(self, fh, default=None):
+		offset = self.find(fh)[1]
+		if not offset:
+			return default
+		return self.record(offset)[1]
+
+	def __setitem__(self, fh, info):
+		assert self.writable, 'ancestry store {} is read only'.format(self.path)
+		if (self.count + 1) * 10 > self.nslots * 7:
+			self.grow()
+		i, old = self.find(fh)
+		data = cPickle.dumps((fh, info), cPickle.HIGHEST_PROTOCOL)
+		offset = self.dsize
+		self.df.seek(offset)
+		self.df.write(self.reclen.pack(len(data)) + data)
+		self.df.flush()
+		self.dsize += self.reclen.size + len(data)
+		if not old:
+			self.count += 1
+		# Write the offset before the key, so a reader never matches the key without a record
+		self.table[i * self.slot.size + 16:(i + 1) * self.slot.size] = struct.pack('<Q', offset)
+		self.table[i * self.slot.size:i * self.slot.size + 16] = hashlib.md5(fh).digest()
+
+	# Double the size of the table, writing the new table to a temporary file and renaming it
+	# so any children still reading the old table keep a consistent (but older) copy
+	def grow(self):
+		slots = [self.slot.unpack_from(self.table, i * self.slot.size) for i in xrange(self.nslots)]
+		self.nslots *= 2
+		table = bytearray(self.nslots * self.slot.size)
+		for key, offset in slots:
+			if not offset:
+				continue
+			i = struct.unpack_from('<Q', key)[0] % self.nslots
+			while struct.unpack_from('<Q', table, i * self.slot.size + 16)[0]:
+				i = (i + 1) % self.nslots
+			self.slot.pack_into(table, i * self.slot.size, key, offset)
+		with open(self.path + '.tbl.tmp', 'wb') as f:
+			f.write(table)
+		os.rename(self.path + '.tbl.tmp', self.path + '.tbl')
+		self.close()
+		self.open(writable=True)
+
+	def update(self, other):
+		for fh, info in other.iteritems():
+			self[fh] = info
+
+	def __len__(self):
+		return self.count
+
+	def iteritems(self):
+		for i in xrange(self.nslots):
+			offset = self.slot.unpack_from(self.table, i * self.slot.size)[1]
+			if offset:
+				yield self.record(offset)
+
+	def __iter__(self):
+		for fh, _ in self.iteritems():
+			yield fh
+
+#
+# Follows the parfh chains of dirs through one or more maps of handles to index tuples
+# (mb.ancestry, index.ancestries, ...), remembering for each handle whether its chain reaches the root
+# or where it is broken.  A chain can also be broken by a loop in bad ancestry; the handle where the loop
+# was found is also kept in loops, so a dir in a loop is not taken for a missing one.
+# Siblings and cousins share most of their chain, so with the results cached
+# for every handle along the way (path compression), each handle is looked up about once per batch
+# instead of once for every file and dir under it.  The parent function gets the parent handle from
+# an entry in the maps; by default the entries are index tuples.
+class AncestryResolver(object):
+	def __init__(self, *maps, **kwargs):
+		self.maps = maps
+		self.parent = kwargs.get('parent', lambda entry: entry[idx.IdxEnt.PARFH])
+		self.cache = {}
+		self.loops = set()
+
+	def lookup(self, fh):
+		for m in self.maps:
+			entry = m.get(fh)
+			if entry is not None:
+				return entry
+		return None
+
+	# Returns None if fh and all its ancestors are known all the way to the root
+	# (the root entry has parfh None), or else the first handle in the chain that is missing,
+	# or the handle where the chain loops back on itself (see isLoop)
+	def brokenAt(self, fh):
+		trail = []
+		seen = set()
+		result = None
+		while fh:
+			if fh in self.cache:
+				result = self.cache[fh]
+				break
+			entry = self.lookup(fh)
+			if entry is None or fh in seen:
+				# Missing, or a loop in bad ancestry, which is broken too
+				if entry is not None:
+					self.loops.add(fh)
+				self.cache[fh] = result = fh
+				break
+			trail.append(fh)
+			seen.add(fh)
+			fh = self.parent(entry)
+		for t in trail:
+			self.cache[t] = result
+		return result
+
+	# Whether a handle returned by brokenAt is where a loop was found, rather than a missing dir
+	def isLoop(self, fh):
+		return fh in self.loops
+
+	# Yields (fh, entry) for fh and each of its ancestors that can be found
+	def trail(self, fh):
+		seen = set()
+		while fh and fh not in seen:
+			entry = self.lookup(fh)
+			if entry is None:
+				return
+			seen.add(fh)
+			yield fh, entry
+			fh = self.parent(entry)
+
+	# If full ancestry of the filehandle is available then return it all in a dict
+	# Returns either the complete ancestry in a dict, or None
+	def fullAncestry(self, fh):
+		if not fh or self.brokenAt(fh) is not None:
+			return None
+		return dict(self.trail(fh))
 
 #
 # Tasks based on IndexDiagBatch can look into the actual index batches and find problems
@@ -78,15 +352,47 @@ Stats = ["missing", "located", "gotAncestry"]
 # This messy boilerplace stuff is required so that idx.ProcessBatches can call us back
 # The messy part is kept here as-is and it's subclassed below for each of three different phases
 class IndexDiagBatch(sched.Task):
+	# The reader creates the tasks in the parent process in index order, so this numbers the multibatches
+	# IndexDiag resets the counts for each pass, and sets workers to the -parallel number of batch workers
+	dispatched = 0
+	finished = 0
+	workers = 1
+
 	def __init__(self, index, batches, resTube=None, process=True):
 		self.resTube = resTube
+		self.seq = IndexDiagBatch.dispatched
+		IndexDiagBatch.dispatched += 1
+		IndexDiagBatch.updateStats()
 		producer = self.gRun(index, batches)
 		super(IndexDiagBatch, self).__init__(index, batches, producer=producer, process=process)
 
 	# This runs in the parent process to get the results from the child
 	def cfun(self, result):
+		IndexDiagBatch.finished += 1
+		IndexDiagBatch.updateStats()
 		if self.resTube:
-			self.resTube.send(result)
+			self.resTube.send((self.seq, result))
+
+	# The tasks that were created and have not finished are either running in a worker or waiting for one
+	@staticmethod
+	def updateStats():
+		running = IndexDiagBatch.dispatched - IndexDiagBatch.finished
+		busy = min(running, IndexDiagBatch.workers)
+		sched.engine.stats["busy"] = busy
+		sched.engine.stats["idle"] = IndexDiagBatch.workers - busy
+		sched.engine.stats["queued"] = running - busy
+
+	# Send the number of entries in the multibatch along with the results, for ReadCredits
+	def sized(self, mb, results):
+		return (len(mb.files) + len(mb.dirs) + len(mb.ancestry), results)
+
+# Yields (x, fh, loop) for each file and dir in the multibatch whose parfh chain does not reach the root,
+# where fh is the first missing dir in the chain, or the dir where it loops if loop is True
+def brokenEntries(mb, resolver):
+	for x in chain(mb.files, mb.dirs):
+		fh = resolver.brokenAt(x.parfh)
+		if fh:
+			yield x, fh, resolver.isLoop(fh)
 
 class DiagnoseBatch(IndexDiagBatch):
 	def gRun(self, index, batches):
@@ -97,41 +403,72 @@ class DiagnoseBatch(IndexDiagBatch):
 			yield
 
 		missing = set()
+		loops = set()
 		mb = idx.MultiBatch(index, batches, self.log)
+		resolver = AncestryResolver(mb.ancestry)
 
-		for x in chain(mb.files, mb.dirs):
-			parfh = x.parfh
-			while parfh:
-				if parfh not in mb.ancestry:
-					missing.add(parfh)
+		for x, parfh, loop in brokenEntries(mb, resolver):
+			if loop:
+				# The dir is there but its ancestry loops; locating can't fix that
+				loops.add(parfh)
+				sched.engine.stats["loops"] += 1
+			else:
+				missing.add(parfh)
+				sched.engine.stats["missing"] += 1
+
+		# Dirs that are not missing but the option treats as missing for testing
+		if self.options.chose(tryMissingOption):
+			for x in chain(mb.files, mb.dirs):
+				if x.a.type == nfs3.DIR and x.digest:
 					sched.engine.stats["missing"] += 1
-					break
-				entry = mb.ancestry[parfh]
-				parfh = entry[idx.IdxEnt.PARFH]
+					missing.add(x.fh)
 
-			# Dir is not missing but the option treats it as missing for testing
-			if self.options.chose(tryMissingOption) and x.a.type == nfs3.DIR and x.digest:
-				sched.engine.stats["missing"] += 1
-				missing.add(x.fh)
+		# For -onepass, also send back the index tuple of every dir in this multibatch
+		# so the parent process can find the missing ancestry without the Locating pass
+		dirs = None
+		if self.options.chose(onePassOption):
+			dirs = dict(mb.ancestry.iteritems())
 
 		# This is a child process so results have to support pickling
 		# (any python objects are fine; however our cython objects such as File3 are not)
-		self.results = missing
-
-# If full ancestry of the filehandle is available then return it all in a dict
-# Returns either the complete ancestry in a dict, or None
-def fullAncestry(dfh, ancestry):
-	dirs = {}
-	while True:
-		if dfh not in ancestry:
-			# No luck; complete ancestry not found
-			return None
-		info = ancestry.get(dfh)
-		dirs[dfh] = info
-		dfh = info[idx.IdxEnt.PARFH]
-		if dfh is None:
-			# The root entry has parfh None, so we are successful
-			return dirs
+		self.results = self.sized(mb, (missing, loops, dirs))
+
+# For -onepass, find the missing dirs and their ancestry in the store of all the dirs in the index;
+# this does the same thing as the Locating phase, but the ancestry can come from any batches instead
+# of a single multibatch.  Only the tuples of the located dirs and their ancestry are read from the store
+def locateInStore(index, dirs):
+	resolver = AncestryResolver(dirs)
+	for dfh in index.missingDirs:
+		info = dirs.get(dfh)
+		if info is None:
+			continue
+		sched.engine.stats["located"] += 1
+		index.locatedDirs[dfh] = info
+
+		if resolver.brokenAt(dfh) is None:
+			sched.engine.stats["gotAncestry"] += 1
+			index.gotAncestry.add(dfh)
+			for afh, info in resolver.trail(dfh):
+				if afh not in index.ancestries:
+					index.ancestries[afh] = info
+
+# The Locating phase only finds full ancestry for a dir if the whole chain is in a single multibatch
+# (or for -onepass, anywhere in the index).  The chains of the rest of the located dirs might still be
+# completed by other located dirs, so try again with the transitive closure over all of them
+# Returns the number of located dirs that got full ancestry this way
+def closeAncestry(index):
+	n = 0
+	resolver = AncestryResolver(index.ancestries, index.locatedDirs)
+	for dfh in index.locatedDirs:
+		if dfh in index.gotAncestry or resolver.brokenAt(dfh) is not None:
+			continue
+		n += 1
+		sched.engine.stats["gotAncestry"] += 1
+		index.gotAncestry.add(dfh)
+		for afh, info in resolver.trail(dfh):
+			if afh not in index.ancestries:
+				index.ancestries[afh] = info
+	return n
 
 # Look for dir metadata entries and ancestry for
 # each dir that was found in the Diagnose phase
@@ -149,6 +486,7 @@ class LocateBatch(IndexDiagBatch):
 		ancestries = {}
 
 		mb = idx.MultiBatch(index, batches, self.log)
+		resolver = AncestryResolver(mb.ancestry)
 		for dfh in (index.missingDirs):
 			# If full ancestry is already found, we are done
 			if dfh in index.ancestries:
@@ -158,57 +496,625 @@ class LocateBatch(IndexDiagBatch):
 				sched.engine.stats["located"] += 1
 				located[dfh] = mb.ancestry[dfh]
 			# Now check if the whole trail back to the root is in there
-			a = fullAncestry(dfh, mb.ancestry)
+			a = resolver.fullAncestry(dfh)
 			if a:
 				sched.engine.stats["gotAncestry"] += 1
 				gotAncestry.add(dfh)
 				ancestries.update(a)
 
-		self.results = (located, gotAncestry, ancestries)
+		self.results = self.sized(mb, (located, gotAncestry, ancestries))
 
 class RebuildBatch(IndexDiagBatch):
 	def gRun(self, index, batches):
 		self.name = "rebuild mb {}".format(idx.getName(batches))
 		if 0:
 			yield
+		if self.seq < index.skipBatches:
+			# Already in the new index file from a previous run
+			self.results = (0, ('', 0, ''))
+			return
 		mb = idx.MultiBatch(index, batches, self.log)
 
 		# All of mb's data structures have been updated with the snap delta, if there is one,
 		# and also the info from the renames file.  Any ancestry that we located in other batches
-		# has similarly been updated with the same info, so it should be safe to just merge it in.
-		mb.ancestry.update(index.ancestries)
+		# has similarly been updated with the same info, so it should be safe to merge it in.
+		# Only merge the entries this multibatch actually needs, i.e. the ones missing from the
+		# parfh chains of its own files and dirs; otherwise every rebuild would add all of
+		# index.ancestries to every batch and the index would keep growing.
+		injected = 0
+		checked = set()
+		for x in chain(mb.files, mb.dirs):
+			parfh = x.parfh
+			while parfh and parfh not in checked:
+				checked.add(parfh)
+				entry = mb.ancestry.get(parfh)
+				if entry is None:
+					entry = index.ancestries.get(parfh)
+					if entry is None:
+						break
+					mb.ancestry[parfh] = entry
+					injected += 1
+				parfh = entry[idx.IdxEnt.PARFH]
+		sched.engine.stats["injected"] += injected
 
-		# TODO:
-		# If index.ancestries, containing full ancestry of everything that was missing, is very large
-		# then it does not have to be added to every batch.  Over time if you rebuild the index a lot,
-		# this will be a problem.  A batch should just have the ancestry it needs.  
+		# Dirs in index.locatedDirs for which the Locating phase did not find full ancestry
+		# were already checked against locatedDirs itself by closeAncestry, and if the chain could be
+		# completed that way, it was added to index.ancestries, which is merged in above.
 
-		# TODO: if there are dirs in index.locatedDirs for which we did not find full ancestry,
-		# it seems like there ought to be a way to see if locatedDirs itself has their ancestry.
-		# It might, and if it does then they can be merged in also.
+		# For compaction, drop the ancestry entries that are not on the chain of any file or dir in the batch
+		ancestry = mb.ancestry
+		if index.trimAncestry:
+			ancestry = dict((fh, mb.ancestry[fh]) for fh in checked if fh in mb.ancestry)
+			sched.engine.stats["trimmed"] += len(mb.ancestry) - len(ancestry)
 
 		# Now just save a nice new rebuilt batch in the new index
 		id = "rebuild [{}]".format(len(mb.headers))
-		self.results = idx.reindex(id, mb.ancestry, mb.files, mb.dirs, stamp=False)
+		# Encode and compress it here in the worker, so the parent process only has to write it
+		newbh, newbd = idx.reindex(id, ancestry, mb.files, mb.dirs, stamp=False)
+		batchData = idx.encodeIndexBatch(newbh, None, newbd)
+
+		# For -fhmap, a sorted run of the map records for the dirs in this batch
+		run = ''
+		if index.fhMap:
+			run = ''.join(sorted(FhMap.record.pack(fhKey(x.fh), fhKey(x.parfh), self.seq) for x in mb.dirs))
+		self.results = self.sized(mb, (batchData, injected, run))
+
+# Check that the parfh chain of every file and dir in the multibatch reaches the root
+# using just the multibatch's own ancestry, which is what a sync or resume has to work with
+# The results are the number of entries, the number broken, and a few examples
+# After -maxfail failures, IndexDiag sets index.stopValidation, and the rest of the batches are skipped
+class ValidateBatch(IndexDiagBatch):
+	def gRun(self, index, batches):
+		self.name = "validate mb {}".format(idx.getName(batches))
+		if 0:
+			yield
+		if index.stopValidation:
+			self.results = (0, None)
+			return
+
+		mb = idx.MultiBatch(index, batches, self.log)
+		resolver = AncestryResolver(mb.ancestry)
+		n = len(mb.files) + len(mb.dirs)
+		broken = 0
+		examples = []
+		for x, parfh, loop in brokenEntries(mb, resolver):
+			broken += 1
+			if len(examples) < 3:
+				examples.append("{} {} {}".format(x.fh.encode('hex'), loop and 'ancestry loops at' or 'missing parent',
+					parfh.encode('hex')))
+		sched.engine.stats["validated"] += n
+		sched.engine.stats["broken"] += broken
+		self.results = self.sized(mb, (idx.getName(batches), n, broken, examples))
+
+# Collects the ValidateBatch results in the parent and decides when to stop
+class Validation(object):
+	def __init__(self, log, maxFailures):
+		self.log = log
+		self.maxFailures = maxFailures
+		self.passed = 0
+		self.failed = 0
+		self.entries = 0
+		self.broken = 0
+
+	# Returns True when there have been enough failures to stop
+	def add(self, seq, result):
+		name, n, broken, examples = result
+		self.entries += n
+		self.broken += broken
+		if not broken:
+			self.passed += 1
+			self.log.log("  mb {} {}: pass ({} entries)".format(seq, name, n))
+			return False
+		self.failed += 1
+		self.log.log("  mb {} {}: FAIL ({} entries, {} broken)".format(seq, name, n, broken), out=True)
+		for e in examples:
+			self.log.log("    {}".format(e), out=True)
+		return self.maxFailures and self.failed >= self.maxFailures
+
+# Stands in for the zlib module in idx while a multibatch is decoded, to count the compressed bytes
+# read from the index and the raw bytes they decompress to
+class ZlibCounter(object):
+	def __init__(self):
+		self.compressed = 0
+		self.raw = 0
+
+	def count(self, data, out):
+		self.compressed += len(data)
+		self.raw += len(out)
+		return out
+
+	def decompress(self, data, *args):
+		return self.count(data, zlib.decompress(data, *args))
+
+	def decompressobj(self, *args):
+		return CountingDecompressor(self, zlib.decompressobj(*args))
+
+	def __getattr__(self, name):
+		return getattr(zlib, name)
+
+class CountingDecompressor(object):
+	def __init__(self, counter, d):
+		self.counter = counter
+		self.d = d
+
+	def decompress(self, data, *args):
+		return self.counter.count(data, self.d.decompress(data, *args))
+
+	def __getattr__(self, name):
+		return getattr(self.d, name)
+
+# Profile one multibatch for -stats: how big its batches are in the index file and decompressed,
+# how long it takes to decode, and which ancestry entries it has, so the parent can count the duplicates
+class StatsBatch(IndexDiagBatch):
+	def gRun(self, index, batches):
+		self.name = "stats mb {}".format(idx.getName(batches))
+		if 0:
+			yield
+
+		counter = ZlibCounter()
+		saved, idx.zlib = idx.zlib, counter
+		try:
+			t = time.time()
+			mb = idx.MultiBatch(index, batches, self.log)
+			decodeTime = time.time() - t
+		finally:
+			idx.zlib = saved
+
+		row = (self.seq, idx.getName(batches), len(mb.headers), len(mb.files) + len(mb.dirs), len(mb.ancestry),
+			counter.raw, counter.compressed, decodeTime)
+		self.results = self.sized(mb, (row, list(mb.ancestry)))
+
+# Counts how many multibatches have each ancestry entry, in bounded memory however big the index is
+# The most duplicated handles are found with the Misra-Gries algorithm: at most capacity counters are kept,
+# and when a new handle does not fit, every counter is decremented and the zeros are dropped,
+# so a count can be low by at most the number of entries divided by capacity
+# The number of distinct dirs is estimated from the kmv smallest hash values (k minimum values)
+class AncestryCounts(object):
+	capacity = 10000
+	kmv = 4096
+
+	def __init__(self):
+		self.total = 0
+		self.counts = {}
+		self.decrements = 0
+		self.smallest = []
+		self.inSmallest = set()
+
+	def add(self, fhs):
+		for fh in fhs:
+			self.total += 1
+			if fh in self.counts:
+				self.counts[fh] += 1
+			elif len(self.counts) < self.capacity:
+				self.counts[fh] = 1
+			else:
+				self.decrements += 1
+				for k in self.counts.keys():
+					if self.counts[k] == 1:
+						del self.counts[k]
+					else:
+						self.counts[k] -= 1
+
+			h = struct.unpack_from('<Q', hashlib.md5(fh).digest())[0]
+			if h in self.inSmallest:
+				continue
+			if len(self.smallest) < self.kmv:
+				heapq.heappush(self.smallest, -h)
+				self.inSmallest.add(h)
+			elif h < -self.smallest[0]:
+				self.inSmallest.discard(-heapq.heappushpop(self.smallest, -h))
+				self.inSmallest.add(h)
+
+	def distinct(self):
+		if len(self.smallest) < self.kmv:
+			return len(self.smallest)
+		return int((self.kmv - 1) * float(1 << 64) / -self.smallest[0])
+
+	def mostCommon(self, n):
+		return heapq.nlargest(n, self.counts.items(), key=lambda item: item[1])
+
+# Collects the StatsBatch results in the parent and prints the -stats report
+class IndexProfile(object):
+	columns = ('mb', 'name', 'batches', 'entries', 'ancestry', 'raw', 'bytes', 'decode')
+
+	def __init__(self):
+		self.rows = []
+		self.ancestry = AncestryCounts()
+
+	def add(self, result):
+		row, ancestry = result
+		self.rows.append(row)
+		self.ancestry.add(ancestry)
+
+	# Print min, median, 90th percentile, max, and a histogram with power of 2 buckets
+	def distribution(self, log, title, values, fmt=str):
+		values = sorted(values)
+		n = len(values)
+		log("  {}: min {} median {} p90 {} max {}".format(title,
+			fmt(values[0]), fmt(values[n / 2]), fmt(values[n * 9 / 10]), fmt(values[-1])))
+		hist = Counter(int(v).bit_length() for v in values)
+		for b in sorted(hist):
+			log("    {:>10} - {:<10} {}".format(fmt(b and 1 << (b - 1)), fmt((1 << b) - 1), hist[b]))
+
+	def report(self, log, top=10):
+		if not self.rows:
+			log("  empty index")
+			return
+		col = dict((c, i) for i, c in enumerate(self.columns))
+		total = lambda c: sum(row[col[c]] for row in self.rows)
+		log("  multibatches {} batches {} entries {} ancestry entries {}".format(
+			len(self.rows), total('batches'), total('entries'), total('ancestry')))
+		self.distribution(log, "batches per multibatch", [row[col['batches']] for row in self.rows])
+		self.distribution(log, "entries per multibatch", [row[col['entries']] for row in self.rows])
+		self.distribution(log, "compressed bytes per multibatch (as stored in the index)", [row[col['bytes']] for row in self.rows],
+			fmt=basics.formatSize)
+		log("  compression: {} raw, {} compressed, ratio {:.2f}".format(basics.formatSize(total('raw')),
+			basics.formatSize(total('bytes')), float(total('raw')) / max(total('bytes'), 1)))
+		log("  decode time: total {:.1f}s avg {:.3f}s max {:.3f}s".format(total('decode'),
+			total('decode') / len(self.rows), max(row[col['decode']] for row in self.rows)))
+
+		# Ancestry is duplicated when the same dir is in the ancestry of more than one multibatch
+		distinct = self.ancestry.distinct()
+		log("  ancestry: {} entries in multibatches, about {} distinct dirs, {:.1f} copies per dir, "
+			"{:.0%} of all entries".format(total('ancestry'), distinct, float(total('ancestry')) / max(distinct, 1),
+			float(total('ancestry')) / max(total('ancestry') + total('entries'), 1)))
+		log("  most duplicated ancestry (dir handle: multibatches{}):".format(
+			self.ancestry.decrements and ', at least' or ''))
+		for fh, n in self.ancestry.mostCommon(top):
+			log("    {}: {}".format(fh.encode('hex'), n))
+
+		log("  hottest multibatches by decode time:")
+		log("    " + ' '.join('{:>12}'.format(c) for c in self.columns))
+		for row in heapq.nlargest(top, self.rows, key=lambda row: row[col['decode']]):
+			log("    " + ' '.join('{:>12}'.format(v if not isinstance(v, float) else '{:.3f}s'.format(v)) for v in row))
+
+# Flow control for the index reader in IndexDiag
+# idx.ProcessBatches reads one multibatch and starts a batch task for it each time it gets a credit
+# (a token sent on the tube), and each finished batch returns its credit.  Enough credits are kept out
+# to keep every batch worker busy plus a few queued multibatches ready for the next free worker,
+# but no more than fit in the memory budget, estimating the memory for each multibatch from the
+# average number of entries in the multibatches so far.  Until the first one finishes there is no
+# estimate, so only one credit is sent.
+class ReadCredits(object):
+	# Rough size of a decoded index entry in a batch worker
+	bytesPerEntry = 512
+
+	def __init__(self, workers, memBudget):
+		self.workers = workers
+		self.memBudget = memBudget
+		self.outstanding = 0
+		self.finished = 0
+		self.entries = 0
+
+	def target(self):
+		if not self.finished:
+			return 1
+		mbSize = self.bytesPerEntry * self.entries / self.finished
+		return max(1, min(self.workers + max(1, self.workers / 4), self.memBudget / max(mbSize, 1)))
+
+	# Returns how many credits to send now
+	def grant(self):
+		n = max(0, self.target() - self.outstanding)
+		self.outstanding += n
+		self.updateStats()
+		return n
+
+	def done(self, entries):
+		self.outstanding -= 1
+		self.finished += 1
+		self.entries += entries
+
+	# The credits are the multibatches the reader has been allowed to read that have not finished yet
+	def updateStats(self):
+		sched.engine.stats["credits"] = self.outstanding
+
+# The checkpoint is saved to a temporary file and renamed, so there is always a complete one
+def saveCheckpoint(path, state):
+	with open(path + '.tmp', 'wb') as f:
+		cPickle.dump(state, f, cPickle.HIGHEST_PROTOCOL)
+	os.rename(path + '.tmp', path)
+
+def loadCheckpoint(path):
+	try:
+		with open(path, 'rb') as f:
+			return cPickle.load(f)
+	except IOError as e:
+		raise sched.ShortError('cannot continue without the checkpoint {}: {}'.format(path, e))
+
+# Writes the rebuilt batches to the new index file in index order
+# The batches finish in any order, so they wait in a dict until all the earlier batches have been added.
+# Then the data is coalesced and written in chunks of the NFS block size at explicit offsets,
+# with up to -maxpend writes in flight, like the Read1/Write1 tasks in bigfile.py
+class OrderedWriter(object):
+	def __init__(self, f, bs, maxPend, start=(0, 0)):
+		self.f = f
+		self.bs = bs
+		self.gate = sched.Gate(maxPend, 'rebuild writes')
+		self.ready = {}
+		self.next, self.offset = start
+		self.pending = []
+		self.npending = 0
+		# For checkpoints: the offsets of the writes in flight,
+		# and the end offset and number of batches at each batch boundary not yet known to be written
+		self.inflight = set()
+		self.boundaries = []
+		self.written = start
+		# The offset and length of each batch added, for the fh map
+		self.extents = []
+
+	# Generator for the IndexDiag task to call with "for y in writer.add(...): yield y"
+	def add(self, seq, data):
+		if seq < self.next:
+			# Skipped because it was written before the checkpoint
+			return
+		self.ready[seq] = data
+		while self.next in self.ready:
+			data = self.ready.pop(self.next)
+			self.next += 1
+			self.extents.append((self.offset + self.npending, len(data)))
+			self.pending.append(data)
+			self.npending += len(data)
+			self.boundaries.append((self.offset + self.npending, self.next))
+			for y in self.write(full=True):
+				yield y
+
+	# Write all the full blocks, or everything if full is False
+	def write(self, full=False):
+		if not self.npending:
+			return
+		data = ''.join(self.pending)
+		n = len(data)
+		if full:
+			n -= n % self.bs
+		for start in xrange(0, n, self.bs):
+			yield (self.gate, None)
+			self.inflight.add(self.offset)
+			WriteChunk(self, self.offset, data[start:start + self.bs]).leaveWhenFinished(self.gate)
+			self.offset += min(self.bs, n - start)
+		self.pending = [data[n:]]
+		self.npending = len(data) - n
+
+	# Write the rest, and then the trailer
+	def close(self, trailer):
+		self.pending.append(trailer)
+		self.npending += len(trailer)
+		for y in self.write():
+			yield y
+		# Wait for any pending writes to finish
+		if not self.gate.close():
+			yield
+		yield (self.f.commit(), None)
+
+	# Returns (batches, offset) for the last batch boundary before any unfinished writes
+	def finished(self):
+		low = self.offset
+		if self.inflight:
+			low = min(self.inflight)
+		i = 0
+		while i < len(self.boundaries) and self.boundaries[i][0] <= low:
+			i += 1
+		if i:
+			offset, batches = self.boundaries[i - 1]
+			self.written = (batches, offset)
+			del self.boundaries[:i]
+		return self.written
+
+	# Commit what's been written so far and pass the batch boundary to the checkpoint function
+	def checkpoint(self, fun):
+		batches, offset = self.finished()
+		yield (self.f.commit(), None)
+		fun(batches, offset)
+
+class WriteChunk(sched.SimpleTask):
+	def gRun(self, writer, offset, data):
+		yield (writer.f.write(offset, data, stable=nfs3.Stable_mode.UNSTABLE), None)
+		writer.inflight.discard(offset)
+
+# The short hash of a handle used in the fh map; the root's parent (None) is all zeros
+def fhKey(fh):
+	if not fh:
+		return '\0' * 8
+	return hashlib.md5(fh).digest()[:8]
+
+#
+# The fh map is a sidecar file next to the index (the index file name plus .fhmap) so tools can read
+# just the batches they need for a dir instead of the whole index.  It has a header, the offset and length
+# of every batch in the index, and then a record for every dir in the index: the short hashes of
+# its handle and its parent's handle and its batch number, sorted by the handle hash.
+# Finding a dir is a binary search of the records with one small read per step, and following the
+# parent hashes gives the batches with its ancestors.  The header has the size of the index it was
+# written for, so a map left behind by an older index is not used.
+# Only dirs are in the map, to keep it small; it is written by a rebuild or compaction.
+class FhMap(object):
+	header = struct.Struct('<8sQQQ')
+	extent = struct.Struct('<QQ')
+	record = struct.Struct('<8s8sI')
+	magic = 'XCPFHM01'
+
+	def __init__(self, f, nbatches, nrecords):
+		self.f = f
+		self.nbatches = nbatches
+		self.nrecords = nrecords
+		self.extents = []
+
+	def recordOffset(self, i):
+		return self.header.size + self.nbatches * self.extent.size + i * self.record.size
+
+# Collects the sorted runs from the rebuild batches in a local file for merging into the fh map
+class FhMapBuilder(object):
+	# Records per read when merging, for each run
+	chunk = 1024
+
+	def __init__(self, path):
+		self.path = path
+		self.f = open(path, 'w+b')
+		self.runs = []
+		self.nrecords = 0
+		self.extents = []
+		self.indexSize = 0
+
+	def add(self, run):
+		if not run:
+			return
+		n = len(run) / FhMap.record.size
+		self.runs.append((self.f.tell(), n))
+		self.nrecords += n
+		self.f.write(run)
+
+	def readRun(self, start, n):
+		size = FhMap.record.size
+		while n:
+			count = min(n, self.chunk)
+			self.f.seek(start)
+			data = self.f.read(count * size)
+			for i in xrange(0, len(data), size):
+				yield data[i:i + size]
+			start += count * size
+			n -= count
+
+	# Yields all the records in order
+	def records(self):
+		self.f.flush()
+		return heapq.merge(*[self.readRun(start, n) for start, n in self.runs])
+
+	def remove(self):
+		self.f.close()
+		os.remove(self.path)
+
+class WriteFhMap(sched.SimpleTask):
+	def gRun(self, tagd, name, builder):
+		self.name = "write fh map {}".format(name)
+		f = yield (client.CreateTask(tagd, name, sattr=nfs3.Sattr3(mode=0700, size=0)), None)
+		writer = OrderedWriter(f, self.options.get(client.bsizeOption), self.options.get(maxPendOption))
+
+		head = [FhMap.header.pack(FhMap.magic, builder.indexSize, len(builder.extents), builder.nrecords)]
+		head.extend(FhMap.extent.pack(offset, length) for offset, length in builder.extents)
+		for y in writer.add(0, ''.join(head)):
+			yield y
+
+		seq = 1
+		records = []
+		for rec in builder.records():
+			records.append(rec)
+			if len(records) == FhMapBuilder.chunk:
+				for y in writer.add(seq, ''.join(records)):
+					yield y
+				seq += 1
+				records = []
+		for y in writer.close(''.join(records)):
+			yield y
+
+# Reads count bytes at offset, in NFS block size reads
+class ReadBytes(sched.SimpleTask):
+	def gRun(self, f, offset, count):
+		bs = self.options.get(client.bsizeOption)
+		data = []
+		while count > 0:
+			call = yield (f.read(offset, min(bs, count)), None)
+			if not call.res.data:
+				raise sched.ShortError('{} is too short'.format(f))
+			data.append(call.res.data)
+			offset += len(call.res.data)
+			count -= len(call.res.data)
+		self.result = ''.join(data)
+
+# Opens the fh map of an index and reads its header and the batch extents
+class OpenFhMap(sched.SimpleTask):
+	def gRun(self, index):
+		name = index.indexf.name + '.fhmap'
+		self.name = "open fh map {}".format(name)
+		f = yield (client.OpenTask(index.tagd, name), None)
+		indexSize = (yield (client.OpenTask(index.tagd, index.indexf.name), None)).a.size
+
+		data = yield (ReadBytes(f, 0, FhMap.header.size), None)
+		magic, size, nbatches, nrecords = FhMap.header.unpack(data)
+		if magic != FhMap.magic:
+			raise sched.ShortError('{} is not an fh map'.format(name))
+		if size != indexSize:
+			raise sched.ShortError('{} is for a different index (size {}, index size {}); '
+				'rebuild or compact the index with -fhmap to write a new one'.format(name, size, indexSize))
+
+		fhmap = FhMap(f, nbatches, nrecords)
+		data = yield (ReadBytes(f, FhMap.header.size, nbatches * FhMap.extent.size), None)
+		fhmap.extents = [FhMap.extent.unpack_from(data, i * FhMap.extent.size) for i in xrange(nbatches)]
+		self.result = fhmap
+
+# Binary search of the fh map for the record of a handle's hash; the result is (parent hash, batch) or None
+class FindFhKey(sched.SimpleTask):
+	def gRun(self, fhmap, key):
+		self.result = None
+		lo, hi = 0, fhmap.nrecords
+		while lo < hi:
+			mid = (lo + hi) / 2
+			data = yield (ReadBytes(fhmap.f, fhmap.recordOffset(mid), FhMap.record.size), None)
+			k, parent, seq = FhMap.record.unpack(data)
+			if k == key:
+				self.result = (parent, seq)
+				return
+			if k < key:
+				lo = mid + 1
+			else:
+				hi = mid
+
+# Follows a dir's parents through the fh map
+# The result is a list of (hash, batch) for the dir and each ancestor that was found,
+# and the hash of the first ancestor that was not found, which is None if the chain reaches the root
+class FindFhChain(sched.SimpleTask):
+	def gRun(self, fhmap, fh):
+		root = fhKey(None)
+		chain = []
+		seen = set()
+		key = fhKey(fh)
+		while key != root and key not in seen:
+			found = yield (FindFhKey(fhmap, key), None)
+			if not found:
+				break
+			seen.add(key)
+			parent, seq = found
+			chain.append((key, seq))
+			key = parent
+		missing = None
+		if key != root:
+			missing = key
+		self.result = (chain, missing)
 
 # The IndexDiag task just reads the index and runs the processing task for each multibatch
 # When rebuilding, it saves the reencoded data for the new index in the ofile
 # The ofile can be None for the Diagnosing and Locating phases; they just add
 # information to index.missingDirs, index.locatedDirs, index.gotAncestry, index.ancestries
+# For -onepass, the Diagnosing phase also fills in the dirs store, which is kept out of the index object
+# because only the main process uses it
 class IndexDiag(sched.SimpleTask):
-	def gRun(self, index, ofile, batchTaskClass):
+	def gRun(self, index, ofile, batchTaskClass, dirs=None, checkpoint=None, start=(0, 0), profile=None, validation=None,
+		fhmap=None, spill=None):
 		self.name = "read index id '{}'".format(index.name)
 
+		# For rebuilding, the result of this task is the number of ancestry entries added to each batch
+		self.result = []
+
+		if ofile:
+			writer = OrderedWriter(ofile, self.options.get(client.bsizeOption), self.options.get(maxPendOption), start=start)
+			lastCheckpoint = time.time()
+
+		# When continuing a rebuild, the batches before the checkpoint are read but not rebuilt
+		index.skipBatches = start[0]
+		index.stopValidation = False
+
 		# Create a tube to receive results from batch processing tasks as they finsh
 		myEnd, otherEnd = sched.Tube("diff").ends
 
+		IndexDiagBatch.dispatched = IndexDiagBatch.finished = 0
+		IndexDiagBatch.workers = self.options.get(sched.parallelOption)
 		idx.ProcessBatches(index, batchTaskClass, otherEnd)
 
 		# Send some tokens to start the reader
-		# TODO: Design a better way limit the reader; maybe build this feature into the tube in sched
-		for i in range(5):
+		credits = ReadCredits(self.options.get(sched.parallelOption), self.options.get(readMemOption) << 20)
+		for i in range(credits.grant()):
 			myEnd.send(1)
 
+		# Validation can stop early.  The reader has no way to stop, so it still gets its credits and reads to
+		# the end of the index, but the batch tasks are created in this process, so they see index.stopValidation
+		# and return right away without decoding their batches
 		while 1:
 			try:
 				result = myEnd.receive()
@@ -218,23 +1124,134 @@ class IndexDiag(sched.SimpleTask):
 			except idx.EndOfIndex:
 				break
 
+			seq, (entries, result) = result
+			credits.done(entries)
+
 			if batchTaskClass == RebuildBatch:
-				newbh, newbd = result
-				batchData = idx.encodeIndexBatch(newbh, None, newbd)
-				yield (rw.AppendTask(ofile, batchData), None)
+				batchData, injected, run = result
+				self.result.append(injected)
+				if fhmap:
+					fhmap.add(run)
+				for y in writer.add(seq, batchData):
+					yield y
+				if checkpoint and time.time() - lastCheckpoint > checkpointInterval:
+					for y in writer.checkpoint(checkpoint):
+						yield y
+					lastCheckpoint = time.time()
 			elif batchTaskClass == DiagnoseBatch:
-				index.missingDirs.update(result)
+				missing, loops, mbdirs = result
+				index.missingDirs.update(missing)
+				index.loopDirs.update(loops)
+				if mbdirs:
+					# The same dirs are in the ancestry of many multibatches; only the first copy is stored
+					for dfh, info in mbdirs.iteritems():
+						if dfh not in dirs:
+							dirs[dfh] = info
 			elif batchTaskClass == LocateBatch:
 				(located, gotAncestry, ancestries) = result
 				index.locatedDirs.update(located)
 				index.gotAncestry.update(gotAncestry)
 				index.ancestries.update(ancestries)
+			elif batchTaskClass == StatsBatch:
+				profile.add(result)
+			elif batchTaskClass == ValidateBatch:
+				if result and not index.stopValidation:
+					index.stopValidation = validation.add(seq, result)
+			elif batchTaskClass == PartitionBatch:
+				spill.add(result)
 
-			myEnd.send(1)
+			for i in range(credits.grant()):
+				myEnd.send(1)
 
 		if batchTaskClass == RebuildBatch:
 			(trailer, tdata) = idx.getTrailer("sync trailer")
-			yield (rw.AppendTask(ofile, tdata), None)
+			for y in writer.close(tdata):
+				yield y
+			if fhmap:
+				fhmap.extents = writer.extents
+				fhmap.indexSize = writer.offset
+
+# Returns True if the file is in the index dir
+class FileExists(sched.SimpleTask):
+	def gRun(self, tagd, name):
+		self.name = "look up {}".format(name)
+		try:
+			yield (client.OpenTask(tagd, name), None)
+			self.result = True
+		except Exception:
+			self.result = False
+
+# Replace the index with a rebuilt one, keeping the original index and renames files as .ORIG backups
+# A .ORIG backup from an earlier rebuild or compaction is renamed with the time first, so it is kept too.
+# The index is renamed to the backup and then the rebuilt index is renamed to the index, so no data is
+# copied; between the two renames there is no index, and if the second rename fails the log says how to
+# put the original back.
+# An fh map written for the rebuilt index replaces the old one; an old map is not used with the new index
+# anyway because it was written for an index of a different size
+class ReplaceIndex(sched.SimpleTask):
+	def gRun(self, index, rebuiltIndexName, fhMapName=None):
+		self.name = "replace index id '{}'".format(index.name)
+		stamp = time.strftime('%Y%m%d-%H%M%S')
+
+		# Make the backups, moving any old ones out of the way
+		for f, what in (index.indexf, 'index'), (index.renamef, "'renames' file"):
+			if not f:
+				continue
+			backupName = f.name + '.ORIG'
+			exists = yield (FileExists(index.tagd, backupName), None)
+			if exists:
+				oldName = '{}.{}'.format(backupName, stamp)
+				self.log.log("  keeping the earlier backup - mv {backupName} to {oldName}".format(**vars()), out=True)
+				yield (index.tagd.rename(backupName, index.tagd.fh, oldName), None)
+			self.log.log("  creating backup of existing {what} - mv {f.name} to {backupName}".format(**vars()), out=True)
+			yield (index.tagd.rename(f.name, index.tagd.fh, backupName), None)
+
+		# Replace the index with the rebuilt
+		self.log.log("  Renaming {rebuiltIndexName} to {index.indexf}".format(**vars()), out=True)
+		try:
+			yield (index.tagd.rename(rebuiltIndexName, index.tagd.fh, index.indexf.name), None)
+		except Exception:
+			self.log.log("  the index was not replaced; to put the original back, rename {}.ORIG to {} in the catalog".format(
+				index.indexf.name, index.indexf.name), out=True)
+			raise
+		if fhMapName:
+			self.log.log("  Renaming {fhMapName} to {index.indexf}.fhmap".format(**vars()), out=True)
+			yield (index.tagd.rename(fhMapName, index.tagd.fh, index.indexf.name + '.fhmap'), None)
+
+# Creates the local builder for -fhmap, or returns None
+def newFhMapBuilder(options, index):
+	index.fhMap = options.chose(fhMapOption)
+	if not index.fhMap:
+		return None
+	return FhMapBuilder(os.path.join(options.get(workDirOption), 'indexdiag.{}.fhmap'.format(index.name)))
+
+# Writes the fh map next to the rebuilt index; the result is its name
+class FinishFhMap(sched.SimpleTask):
+	def gRun(self, index, rebuiltIndexName, builder):
+		name = rebuiltIndexName + '.fhmap'
+		self.log.log("  writing fh map {} ({} dirs)".format(name, builder.nrecords), out=True)
+		try:
+			yield (WriteFhMap(index.tagd, name, builder), None)
+		finally:
+			builder.remove()
+		self.result = name
+
+# Wraps the zlib module for idx so that the index batches are compressed at the -zlevel level
+# instead of the level idx asks for; idx's encoding does not take a level, so this is the only way to set it
+# The batch workers are forked from the main process, so they use it too
+# RunIndexCompact puts the real module back when it is done
+class ZlibLevel(object):
+	def __init__(self, level):
+		self.level = level
+
+	def compress(self, data, level=None):
+		return zlib.compress(data, self.level)
+
+	def compressobj(self, level=None, *args):
+		return zlib.compressobj(self.level, *args)
+
+	def __getattr__(self, name):
+		return getattr(zlib, name)
 
 class RunIndexDiag(command.Runner):
 	def gRun(self, cmd, catalog):
@@ -243,6 +1260,46 @@ class RunIndexDiag(command.Runner):
 		self.name = "diag index id '{}'".format(index.name)
 		sched.engine.statsTask.addStats(Stats)
 
+		# Validation also only reads the index
+		if self.options.chose(validateOption):
+			self.log.log("validating index {}".format(index.name), out=True)
+			validation = Validation(self.log, self.options.get(maxFailuresOption))
+			yield (IndexDiag(index, None, ValidateBatch, validation=validation), None)
+			self.log.log("  {} multibatches passed, {} failed; {} entries checked, {} with broken ancestry".format(
+				validation.passed, validation.failed, validation.entries, validation.broken), out=True)
+			if index.stopValidation:
+				self.log.log("  stopped after {} failed multibatches ({}); the rest of the index was not checked".format(
+					validation.failed, maxFailuresOption), out=True)
+			if validation.failed:
+				raise sched.ShortError('index {} failed validation'.format(index.name))
+			return
+
+		# Lookup only reads the fh map
+		if self.options.chose(lookupOption):
+			try:
+				fh = self.options.get(lookupOption).decode('hex')
+			except TypeError:
+				raise sched.ShortError('{} needs a file handle in hex'.format(lookupOption))
+			fhmap = yield (OpenFhMap(index), None)
+			chain, missing = yield (FindFhChain(fhmap, fh), None)
+			if not chain:
+				raise sched.ShortError('{} is not a dir in the fh map of index {}'.format(fh.encode('hex'), index.name))
+			self.log.log("dir {} and its ancestors are in these batches of index {}:".format(fh.encode('hex'), index.name), out=True)
+			for key, seq in chain:
+				offset, length = fhmap.extents[seq]
+				self.log.log("  {} batch {} offset {} length {}".format(key.encode('hex'), seq, offset, length), out=True)
+			if missing:
+				self.log.log("  ancestry is broken: {} is not in the index".format(missing.encode('hex')), out=True)
+			return
+
+		# The -stats profile only reads the index; it does not look at the source or target
+		if self.options.chose(statsOption):
+			self.log.log("index profile (-ibatch {})".format(self.options.get(idx.iBatchOption)), out=True)
+			profile = IndexProfile()
+			yield (IndexDiag(index, None, StatsBatch, profile=profile), None)
+			profile.report(lambda s: self.log.log(s, out=True))
+			return
+
 		# missingDirs is a set of filehandles
 		# locatedDirs is a mapping of those filehandles to index tuples (i.e. full metadata about the dir)
 		# gotAncestry is a set of handles for which we found full ancestry; hopefully all locatedDirs have full ancestry too
@@ -250,66 +1307,157 @@ class RunIndexDiag(command.Runner):
 		# The rebuild phase will add the ancestries back into each multibatch so they are not missing anymore
 		# We track the locatedDirs and gotAncesty separately so they can be counted and compared to missingDirs;
 		# It is possible that some might not have full ancestries found anywhere which would be annoying
-		index.missingDirs = set()
-		index.locatedDirs = {}
-		index.gotAncestry = set()
-		index.ancestries = {}
+		# The two maps of handles to tuples can get very big on a badly damaged index,
+		# so they are kept in local memory-mapped files (see AncestryStore)
+		storePath = os.path.join(self.options.get(workDirOption), 'indexdiag.{}'.format(index.name))
 
-		# Run each pass through the index
-		# Diagnosing find dirs that were missing from the ancestry of some batch
-		# Locating uses the results of the Diagnosing phase to find full ancestry for those
-		# Rebuilding uses the results of the Locating phase, and creates a viable index with complete ancestry
-
-		## Phase 1: Diagnosing ##
-		# Read the index and process the batches
-		self.log.log("index diagnostics phase 1 (Diagnosing)", out=True)
-		yield (IndexDiag(index, None, DiagnoseBatch), None)
-
-		# Index pass is done.  Report what we found
-		self.log.log("  total missing {}".format(len(index.missingDirs)), out=True)
-
-		## Phase 2: Locating ##
-		self.log.log("\n", out=True)
-		self.log.log("index diagnostics phase 2 (Locating)", out=True)
-		yield (IndexDiag(index, None, LocateBatch), None)
-		self.log.log("  total missing {} located {} gotAncestry {} ancestries {}".format(
-			len(index.missingDirs), len(index.locatedDirs), len(index.gotAncestry), len(index.ancestries)), out=True)
-
-		## Phase 3: Rebuilding ##
-		self.log.log("\n", out=True)
-		self.log.log("index diagnostics phase 3 (Rebuilding)", out=True)
-		if not self.options.chose(rebuildOption):
-			self.log.log("  phase skipped.  use -rebuild option to force rebuild", out=True)
-			return
-		rebuiltIndexName = index.name + ".new"
+		# The checkpoint has the results of the first two phases and how far the rebuild got
+		# With -continue, start from there instead of from the beginning
+		ckptPath = storePath + '.ckpt'
+		state = None
+		if self.options.chose(continueOption):
+			state = loadCheckpoint(ckptPath)
+			if state['ibatch'] != self.options.get(idx.iBatchOption):
+				raise sched.ShortError('{} {} must be the same as the first run ({})'.format(
+					idx.iBatchOption, self.options.get(idx.iBatchOption), state['ibatch']))
+			index.missingDirs = state['missing']
+			index.locatedDirs = AncestryStore.load(*state['located'])
+			index.gotAncestry = state['gotAncestry']
+			index.ancestries = AncestryStore.load(*state['ancestries'])
+		else:
+			# A checkpoint left by an earlier run does not go with the new stores
+			if os.path.exists(ckptPath):
+				os.remove(ckptPath)
+			index.missingDirs = set()
+			index.loopDirs = set()
+			index.locatedDirs = AncestryStore(storePath + '.located')
+			index.gotAncestry = set()
+			index.ancestries = AncestryStore(storePath + '.ancestries')
+		index.trimAncestry = False
 
-		self.log.log("  using ancestry info located in previous phase", out=True)
+		finished = False
+		try:
+			# dirs is only used by -onepass; it is a store of the index tuple of every dir
+			dirs = None
+			onePass = self.options.chose(onePassOption)
 
-		# Create the output file, read the index and process the batches
-		rebuiltIndexf = yield (client.CreateTask(index.tagd, rebuiltIndexName, sattr=nfs3.Sattr3(mode=0700, size=0)), None)
-		yield (IndexDiag(index, rebuiltIndexf, RebuildBatch), None)
+			# Run each pass through the index
+			# Diagnosing find dirs that were missing from the ancestry of some batch
+			# Locating uses the results of the Diagnosing phase to find full ancestry for those
+			# Rebuilding uses the results of the Locating phase, and creates a viable index with complete ancestry
 
-		oldSize = (yield (client.OpenTask(index.tagd, index.indexf.name), None)).a.size
-		newSize = (yield (client.OpenTask(index.tagd, rebuiltIndexName), None)).a.size
-		self.log.log("  sizes: old index {}; new index {}".format(basics.formatSize(oldSize), basics.formatSize(newSize)), out=True)
+			if state:
+				self.log.log("index diagnostics phases 1 and 2 already done; continuing from {}".format(ckptPath), out=True)
+				self.log.log("  total missing {} located {} gotAncestry {} ancestries {}".format(
+					len(index.missingDirs), len(index.locatedDirs), len(index.gotAncestry), len(index.ancestries)), out=True)
+			else:
+				## Phase 1: Diagnosing ##
+				# Read the index and process the batches
+				if onePass:
+					self.log.log("index diagnostics phase 1 (Diagnosing and Locating)", out=True)
+					dirs = AncestryStore(storePath + '.dirs')
+				else:
+					self.log.log("index diagnostics phase 1 (Diagnosing)", out=True)
+				yield (IndexDiag(index, None, DiagnoseBatch, dirs=dirs), None)
 
-		if not self.options.chose(replaceOption):
-			self.log.log("  not replacing.  use -rebuild -replace to rebuild the index and replace it", out=True)
-			return
+				# Index pass is done.  Report what we found
+				self.log.log("  total missing {}".format(len(index.missingDirs)), out=True)
+				if index.loopDirs:
+					self.log.log("  dirs with ancestry in a loop {} (not missing; they can't be fixed by locating): {}".format(
+						len(index.loopDirs), ', '.join(fh.encode('hex') for fh in sorted(index.loopDirs)[:10])), out=True)
 
-		# Make a backup
-		backupName = index.indexf.name + '.ORIG'
-		self.log.log("  creating backup of existing index - mv {index.indexf} to {backupName}".format(**vars()), out=True)
-		yield (index.tagd.rename(index.indexf.name, index.tagd.fh, backupName), None)
-		if index.renamef:
-			backupName = index.renamef.name + '.ORIG'
-			self.log.log("  creating backup of existing 'renames' file - mv {index.indexf} to {backupName}".format(**vars()), out=True)
-			yield (index.tagd.rename(index.renamef.name, index.tagd.fh, backupName), None)
+				## Phase 2: Locating ##
+				self.log.log("\n", out=True)
+				if onePass:
+					self.log.log("index diagnostics phase 2 (Locating in the dirs from phase 1; {} dirs)".format(len(dirs)), out=True)
+					locateInStore(index, dirs)
+					dirs.remove()
+					dirs = None
+				else:
+					self.log.log("index diagnostics phase 2 (Locating)", out=True)
+					yield (IndexDiag(index, None, LocateBatch), None)
+				closed = closeAncestry(index)
+				if closed:
+					self.log.log("  {} more located dirs got full ancestry from other located dirs".format(closed), out=True)
+				self.log.log("  total missing {} located {} gotAncestry {} ancestries {}".format(
+					len(index.missingDirs), len(index.locatedDirs), len(index.gotAncestry), len(index.ancestries)), out=True)
+				state = {
+					'ibatch': self.options.get(idx.iBatchOption),
+					'missing': index.missingDirs,
+					'gotAncestry': index.gotAncestry,
+					'located': index.locatedDirs.__getstate__(),
+					'ancestries': index.ancestries.__getstate__(),
+					'batches': 0,
+					'offset': 0,
+				}
+				saveCheckpoint(ckptPath, state)
 
-		# Replace the index with the rebuilt
-		self.log.log("  Renaming {rebuiltIndexName} to {index.indexf}".format(**vars()), out=True)
-		yield (index.tagd.rename(rebuiltIndexName, index.tagd.fh, index.indexf.name), None)
-		self.log.log("To validate, run the following command.  If it completes without errors, the index metadata is ok: \nxcp -id {} -match 'x.getPath()==1'".format(index.name), out=True)
+			## Phase 3: Rebuilding ##
+			self.log.log("\n", out=True)
+			self.log.log("index diagnostics phase 3 (Rebuilding)", out=True)
+			if not self.options.chose(rebuildOption):
+				self.log.log("  phase skipped.  use -rebuild option to force rebuild", out=True)
+				finished = True
+				return
+			rebuiltIndexName = index.name + ".new"
+
+			self.log.log("  using ancestry info located in previous phase", out=True)
+
+			# Create the output file, read the index and process the batches
+			# When continuing, the create truncates the file to the end of the last checkpointed batch
+			# and the rebuild skips the batches before it
+			start = (state['batches'], state['offset'])
+			if start[0]:
+				self.log.log("  continuing after batch {} at offset {}".format(*start), out=True)
+			rebuiltIndexf = yield (client.CreateTask(index.tagd, rebuiltIndexName, sattr=nfs3.Sattr3(mode=0700, size=start[1])), None)
+
+			# The fh map needs the offsets of all the batches, which are not in the checkpoint
+			builder = None
+			if start[0] and self.options.chose(fhMapOption):
+				self.log.log("  not writing the fh map when continuing; compact the index with -fhmap to write one", out=True)
+				index.fhMap = False
+			else:
+				builder = newFhMapBuilder(self.options, index)
+
+			def checkpoint(batches, offset):
+				state.update(batches=batches, offset=offset)
+				saveCheckpoint(ckptPath, state)
+
+			injected = yield (IndexDiag(index, rebuiltIndexf, RebuildBatch, checkpoint=checkpoint, start=start, fhmap=builder), None)
+			fhMapName = None
+			if builder:
+				fhMapName = yield (FinishFhMap(index, rebuiltIndexName, builder), None)
+
+			oldSize = (yield (client.OpenTask(index.tagd, index.indexf.name), None)).a.size
+			newSize = (yield (client.OpenTask(index.tagd, rebuiltIndexName), None)).a.size
+			self.log.log("  sizes: old index {}; new index {}".format(basics.formatSize(oldSize), basics.formatSize(newSize)), out=True)
+			if injected:
+				self.log.log("  ancestry entries added: {} in {} batches; per batch avg {:.1f} max {}; {} batches needed none".format(
+					sum(injected), len(injected), float(sum(injected)) / len(injected), max(injected),
+					injected.count(0)), out=True)
+
+			if not self.options.chose(replaceOption):
+				self.log.log("  not replacing.  use -rebuild -replace to rebuild the index and replace it", out=True)
+				finished = True
+				return
+
+			yield (ReplaceIndex(index, rebuiltIndexName, fhMapName), None)
+			self.log.log("To validate, run the following command.  If it completes without errors, the index metadata is ok: \n"
+				"xcp diag -run xcp_index_diag.py indexdiag -id {} -validate".format(index.name), out=True)
+			finished = True
+		finally:
+			# The located ancestry is not needed after the rebuild, or when there was no rebuild.
+			# If it failed after the first two phases, the checkpoint and the stores are kept for -continue;
+			# before that there is nothing to continue from, so they are removed too
+			if dirs is not None:
+				dirs.remove()
+			if not finished and os.path.exists(ckptPath):
+				self.log.log("  keeping {}.* to continue with -continue".format(storePath), out=True)
+			else:
+				index.locatedDirs.remove()
+				index.ancestries.remove()
+				if os.path.exists(ckptPath):
+					os.remove(ckptPath)
 
 indexDiagDesc = command.Desc(
 	"indexdiag",
@@ -317,6 +1465,17 @@ indexDiagDesc = command.Desc(
 		repo.scanTagOption,
 		rebuildOption,
 		replaceOption,
+		onePassOption,
+		continueOption,
+		fhMapOption,
+		lookupOption,
+		statsOption,
+		validateOption,
+		maxFailuresOption,
+		workDirOption,
+		readMemOption,
+		maxPendOption,
+		client.bsizeOption,
 		tryMissingOption,
 		sched.parallelOption,
 		rd.batchOption,
@@ -328,3 +1487,280 @@ indexDiagDesc = command.Desc(
 )
 
 xcp.commands.append((indexDiagDesc, RunIndexDiag))
+
+# Compaction is a rebuild without the diagnosing and locating phases:
+# the reader merges adjacent small batches into multibatches of up to -ibatch,
+# each one is rebuilt with only the ancestry its files and dirs need, and optionally recompressed
+class RunIndexCompact(command.Runner):
+	def gRun(self, cmd, catalog):
+		self.name = "index compact"
+		index, jsonInfo = yield (scan.GetCopyInfo(cmd, catalog), None)
+		self.name = "compact index id '{}'".format(index.name)
+		sched.engine.statsTask.addStats(Stats)
+
+		# Nothing was located, so the rebuild has no ancestry to add; it just drops what's not needed
+		index.missingDirs = set()
+		index.ancestries = {}
+		index.trimAncestry = True
+
+		saved = idx.zlib
+		if self.options.chose(zlevelOption):
+			level = self.options.get(zlevelOption)
+			if not 0 <= level <= 9:
+				raise sched.ShortError('{} must be 0 to 9'.format(zlevelOption))
+			idx.zlib = ZlibLevel(level)
+
+		rebuiltIndexName = index.name + ".new"
+		self.log.log("compacting index {} into {} (-ibatch {})".format(
+			index.name, rebuiltIndexName, self.options.get(idx.iBatchOption)), out=True)
+		try:
+			rebuiltIndexf = yield (client.CreateTask(index.tagd, rebuiltIndexName, sattr=nfs3.Sattr3(mode=0700, size=0)), None)
+			builder = newFhMapBuilder(self.options, index)
+			batches = yield (IndexDiag(index, rebuiltIndexf, RebuildBatch, fhmap=builder), None)
+		finally:
+			idx.zlib = saved
+		fhMapName = None
+		if builder:
+			fhMapName = yield (FinishFhMap(index, rebuiltIndexName, builder), None)
+
+		oldSize = (yield (client.OpenTask(index.tagd, index.indexf.name), None)).a.size
+		newSize = (yield (client.OpenTask(index.tagd, rebuiltIndexName), None)).a.size
+		self.log.log("  {} batches; ancestry entries dropped {}".format(len(batches), sched.engine.stats["trimmed"]), out=True)
+		self.log.log("  sizes: old index {}; new index {}".format(basics.formatSize(oldSize), basics.formatSize(newSize)), out=True)
+
+		if not self.options.chose(replaceOption):
+			self.log.log("  not replacing.  use -replace to compact the index and replace it", out=True)
+			return
+
+		yield (ReplaceIndex(index, rebuiltIndexName, fhMapName), None)
+
+indexCompactDesc = command.Desc(
+	"indexcompact",
+	[
+		repo.scanTagOption,
+		replaceOption,
+		zlevelOption,
+		fhMapOption,
+		workDirOption,
+		readMemOption,
+		maxPendOption,
+		client.bsizeOption,
+		sched.parallelOption,
+		rd.batchOption,
+		idx.iBatchOption,
+	],
+	"Merge small index batches and drop redundant ancestry",
+	npaths=None,
+	runner=RunIndexCompact,
+)
+
+xcp.commands.append((indexCompactDesc, RunIndexCompact))
+
+oldOption = args.OptionInfo('-old', 'name of the older index file in the index dir to diff against', args.Types.String,
+	arg='file name')
+outOption = args.OptionInfo('-out', 'local file for the diff (default: in the -workdir)', args.Types.String, arg='local path')
+partitionsOption = args.OptionInfo('-partitions', 'number of fh hash partitions for the diff', args.Types.Int,
+	arg='#', default=64)
+
+DiffStats = ["partitioned", "added", "removed", "changed"]
+
+# The attributes compared by indexdiff; the parent handle is last
+diffFields = ('type', 'size', 'mtime', 'mode', 'parent')
+
+#
+# The index diff never has either index in memory.  Each index is read once, and the batch workers split
+# the entries of each multibatch into -partitions parts by the hash of the handle.  The main process
+# appends the parts to local spill files, one per partition and index.  Then a worker process for each
+# partition loads the old index's part into a dict, streams the new index's part past it,
+# and writes the added, removed and changed entries to its own output file.
+# So the memory for a partition is about 1/-partitions of one index.
+class PartitionBatch(IndexDiagBatch):
+	def gRun(self, index, batches):
+		self.name = "partition mb {}".format(idx.getName(batches))
+		if 0:
+			yield
+
+		mb = idx.MultiBatch(index, batches, self.log)
+		nparts = self.options.get(partitionsOption)
+		parts = [[] for i in xrange(nparts)]
+		for x in chain(mb.files, mb.dirs):
+			part = struct.unpack_from('<I', hashlib.md5(x.fh).digest())[0] % nparts
+			parts[part].append((x.fh, (x.a.type, x.a.size, x.a.mtime, x.a.mode, x.parfh)))
+		sched.engine.stats["partitioned"] += len(mb.files) + len(mb.dirs)
+		self.results = self.sized(mb, [part and cPickle.dumps(part, cPickle.HIGHEST_PROTOCOL) or '' for part in parts])
+
+# The local spill files for one index; each holds length-prefixed pickled lists of (fh, entry)
+class DiffSpill(object):
+	reclen = struct.Struct('<I')
+
+	def __init__(self, path, nparts):
+		self.paths = ['{}.{}'.format(path, i) for i in xrange(nparts)]
+		self.files = [open(p, 'wb') for p in self.paths]
+
+	def add(self, parts):
+		for f, data in zip(self.files, parts):
+			if data:
+				f.write(self.reclen.pack(len(data)) + data)
+
+	def close(self):
+		for f in self.files:
+			f.close()
+
+	def remove(self):
+		self.close()
+		for p in self.paths:
+			if os.path.exists(p):
+				os.remove(p)
+
+	@classmethod
+	def entries(cls, path):
+		with open(path, 'rb') as f:
+			while True:
+				head = f.read(cls.reclen.size)
+				if not head:
+					return
+				n, = cls.reclen.unpack(head)
+				for fh, entry in cPickle.loads(f.read(n)):
+					yield fh, entry
+
+# A diff line is A (added) or R (removed) with the handle and the entry, or C (changed) with the handle
+# and each field that changed as name=old:new; handles are in hex and the parent of the root is '-'
+def formatDiffEntry(entry):
+	return ' '.join(v.encode('hex') if f == 'parent' and v else str(v if v is not None else '-')
+		for f, v in zip(diffFields, entry))
+
+def formatDiffChange(old, new):
+	changes = []
+	for f, o, n in zip(diffFields, old, new):
+		if o != n:
+			if f == 'parent':
+				o, n = o and o.encode('hex') or '-', n and n.encode('hex') or '-'
+			changes.append('{}={}:{}'.format(f, o, n))
+	return ' '.join(changes)
+
+class DiffPartition(sched.Task):
+	def __init__(self, oldPath, newPath, outPath, resTube):
+		self.resTube = resTube
+		producer = self.gRun(oldPath, newPath, outPath)
+		super(DiffPartition, self).__init__(oldPath, newPath, outPath, producer=producer, process=True)
+
+	def cfun(self, result):
+		self.resTube.send(result)
+
+	def gRun(self, oldPath, newPath, outPath):
+		self.name = "diff {}".format(os.path.basename(newPath))
+		if 0:
+			yield
+
+		counts = Counter()
+		old = dict(DiffSpill.entries(oldPath))
+		with open(outPath, 'wb') as out:
+			for fh, entry in DiffSpill.entries(newPath):
+				o = old.pop(fh, None)
+				if o is None:
+					counts["added"] += 1
+					out.write('A {} {}\n'.format(fh.encode('hex'), formatDiffEntry(entry)))
+				elif o != entry:
+					counts["changed"] += 1
+					for f, a, b in zip(diffFields, o, entry):
+						if a != b:
+							counts[f] += 1
+					out.write('C {} {}\n'.format(fh.encode('hex'), formatDiffChange(o, entry)))
+				else:
+					counts["unchanged"] += 1
+			for fh, entry in old.iteritems():
+				counts["removed"] += 1
+				out.write('R {} {}\n'.format(fh.encode('hex'), formatDiffEntry(entry)))
+		for k in ("added", "removed", "changed"):
+			sched.engine.stats[k] += counts[k]
+		self.results = counts
+
+class RunIndexDiff(command.Runner):
+	def gRun(self, cmd, catalog):
+		self.name = "index diff"
+		index, jsonInfo = yield (scan.GetCopyInfo(cmd, catalog), None)
+		self.name = "diff index id '{}'".format(index.name)
+		sched.engine.statsTask.addStats(DiffStats)
+
+		if not self.options.chose(oldOption):
+			raise sched.ShortError('indexdiff needs {} with the name of the older index file'.format(oldOption))
+		nparts = self.options.get(partitionsOption)
+		if nparts < 1:
+			raise sched.ShortError('{} must be at least 1'.format(partitionsOption))
+
+		# The older index is another file in the same index dir; its renames (if any) are not applied
+		oldIndex = copy.copy(index)
+		oldIndex.indexf = yield (client.OpenTask(index.tagd, self.options.get(oldOption)), None)
+		oldIndex.renamef = None
+
+		workPath = os.path.join(self.options.get(workDirOption), 'indexdiff.{}'.format(index.name))
+		outPath = self.options.get(outOption) or workPath + '.txt'
+		spills = []
+		outPaths = []
+		try:
+			for name, ix in (('old', oldIndex), ('new', index)):
+				self.log.log("reading {} index {} into {} partitions".format(name, ix.indexf.name, nparts), out=True)
+				spill = DiffSpill('{}.{}'.format(workPath, name), nparts)
+				spills.append(spill)
+				yield (IndexDiag(ix, None, PartitionBatch, spill=spill), None)
+				spill.close()
+
+			self.log.log("diffing {} partitions".format(nparts), out=True)
+			oldSpill, newSpill = spills
+			outPaths = ['{}.diff.{}'.format(workPath, i) for i in xrange(nparts)]
+
+			myEnd, otherEnd = sched.Tube("diff partitions").ends
+			gate = sched.Gate(self.options.get(sched.parallelOption), 'diff partitions')
+			for i in xrange(nparts):
+				yield (gate, None)
+				DiffPartition(oldSpill.paths[i], newSpill.paths[i], outPaths[i], otherEnd).leaveWhenFinished(gate)
+			if not gate.close():
+				yield
+
+			counts = Counter()
+			for i in xrange(nparts):
+				result = myEnd.receive()
+				if result is None:
+					result = yield
+				counts.update(result)
+
+			# The diff lines are grouped by partition, i.e. in fh hash order rather than index order
+			with open(outPath, 'wb') as out:
+				for p in outPaths:
+					with open(p, 'rb') as f:
+						while True:
+							data = f.read(1 << 20)
+							if not data:
+								break
+							out.write(data)
+		finally:
+			for spill in spills:
+				spill.remove()
+			for p in outPaths:
+				if os.path.exists(p):
+					os.remove(p)
+
+		self.log.log("  added {} removed {} changed {} unchanged {}".format(
+			counts["added"], counts["removed"], counts["changed"], counts["unchanged"]), out=True)
+		self.log.log("  changed fields: {}".format(', '.join('{} {}'.format(f, counts[f]) for f in diffFields)), out=True)
+		self.log.log("  diff saved in {}".format(outPath), out=True)
+
+indexDiffDesc = command.Desc(
+	"indexdiff",
+	[
+		repo.scanTagOption,
+		oldOption,
+		outOption,
+		partitionsOption,
+		workDirOption,
+		readMemOption,
+		sched.parallelOption,
+		rd.batchOption,
+		idx.iBatchOption,
+	],
+	"Diff an index against an older copy of it",
+	npaths=None,
+	runner=RunIndexDiff,
+)
+
+xcp.commands.append((indexDiffDesc, RunIndexDiff))
@@ -19,13 +19,66 @@
 # Note that timestamps in the logs are in the local time of the system where xcp ran
 # so the age numbers shown will be off if running this utility in a different timezone
 #
+# The log is read one line at a time and each line is parsed into the current command as it goes,
+# so memory does not grow with the size of the log; each command only keeps its first and last entries,
+# the warning counts, and a couple of example warnings of each type
+#
+# The parsed commands are saved in a cache file along with how far the log was parsed,
+# so the next xlog only parses what was appended since.
+# If the log was rotated, truncated or rewritten, it is parsed again from the start.
+# The cache files are pickles, so they are kept in a private directory of the user running xlog (~/.xlogcache),
+# not next to the log where someone else might be able to write them, and a cache file is only used
+# if it and the directory are owned by the user and nobody else can write them.
+# If the cache can't be written, xlog still works; use -nocache to parse the whole log without the cache
+#
+# -f can also be a comma separated list of logs and glob patterns, including gzipped logs, e.g.
+# xcp diag -run xlog.py xlog -f '/opt/NetApp/xFiles/xcp/xcp.log,/opt/NetApp/xFiles/xcp/xcp.x1.log,/archive/xcp*.log.gz'
+# The entries of all the logs are merged in timestamp order as they are read, and parsed as one log
+# The parse cache and -parallel are only used for a single log that is not compressed
+#
+# -db exports the commands, their paths, the indexes and every warning to a SQLite database, e.g.
+# xcp diag -run xlog.py xlog -db /tmp/xlog.db
+# sqlite3 /tmp/xlog.db "select category, count(*) from warnings where command = 'verify.2' group by category"
+# The warnings are written as they are parsed, so -db always parses the whole log without -parallel or the cache
+#
+# -osfix writes a shell script with commands to fix the differences a verify found on the target,
+# copying the attributes from the source with chown, chmod and touch, and copying missing or different files
+# xcp diag -run xlog.py xlog -osfix verify.2 [-out fix.sh]
+# S=/mnt/source T=/mnt/target sh fix.sh
+# The script is written as the log is parsed, a directory at a time, so it can be as big as the verify needs
+#
+# -timeline prints a row for each progress line of a command, and for each rpc channel dump while it ran,
+# with the files and bytes per second, the replies received, and the pending and send queue depths
+# xcp diag -run xlog.py xlog -timeline copy.1 [-out copy.1.csv or -out copy.1.json]
+#
+# -pending reports the rpcs that xcp logged as still pending while a command ran ('pending xid' lines),
+# with the servers, nfs procedures and directories that had the most time overdue (now - duetime in the line)
+# xcp diag -run xlog.py xlog -pending copy.1
+#
+# With -parallel, the part of the log to parse is split into byte ranges at line boundaries,
+# each range is parsed by a worker process, and the pieces are put back together in order
+# The command that is in progress at the start of a range is unknown to its worker, so the worker collects
+# what it finds for it in a ContinuedCommand, which is merged into the real command afterwards
+#
 # TODO:
 # - Redesign the xcp log format to be more standard, so better tools can parse the logs
 
 import os
 import re
+import glob
+import gzip
+import heapq
 import time
 import datetime
+import hashlib
+import cPickle
+import sqlite3
+import ast
+import csv
+import json
+import pipes
+import posixpath
+import tempfile
 from collections import Counter, OrderedDict
 
 import xcp
@@ -39,11 +92,26 @@ import parseargs as args
 def run(argv):
 	xcp.xcp(argv)
 
-logFileOption = args.OptionInfo('-f', 'logfile', args.Types.String, arg='fspath', default=repo.getXcpLogPath())
+logFileOption = args.OptionInfo('-f', 'logfile, or comma separated logfiles and patterns', args.Types.String, arg='fspath',
+	default=repo.getXcpLogPath())
 lineNumbersOption = args.OptionInfo('-n', 'print line numbers')
 longOption = args.OptionInfo('-l', 'include source, target, and any fatal error message for each command')
 showOption = args.OptionInfo('-show', 'get info about a logged command', args.Types.String, arg='command.# (e.g. verify.2)')
 osfixOption = args.OptionInfo('-osfix', 'print commands to fix verify errors', args.Types.String, arg='command.# (e.g. verify.2)')
+outOption = args.OptionInfo('-out', 'local file for the -osfix script (default: <command>.osfix.sh), or the -timeline .csv or .json',
+	args.Types.String, arg='local path')
+pendingOption = args.OptionInfo('-pending', 'rank the servers, directories and nfs procedures of the overdue rpcs of a logged command',
+	args.Types.String, arg='command.# (e.g. copy.1)')
+timelineOption = args.OptionInfo('-timeline', 'print the progress and rpc stats of a logged command over time', args.Types.String,
+	arg='command.# (e.g. copy.1)')
+dbOption = args.OptionInfo('-db', 'export the commands and warnings to a SQLite database', args.Types.String,
+	arg='local path')
+benchmarkOption = args.OptionInfo('-benchmark', 'time the baseline and current parsers on a synthetic log with this many lines', args.Types.Int,
+	arg='# of lines', hidden=True)
+noCacheOption = args.OptionInfo('-nocache', 'parse the whole log without using or saving the parse cache')
+
+# Change this when the parsed objects change, so old cache files are not used
+cacheVersion = 8
 
 class LogInfo(object):
 	def __init__(self, options):
@@ -71,74 +139,136 @@ class LogInfo(object):
 			if cmd.warnings:
 				self.warnWidth = max(len(cmd.wcountstr()), self.warnWidth)
 
+	# The options are not saved in the parse cache; the next run sets its own
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		state['options'] = None
+		return state
+
+# Parsing the timestamps is most of the time it takes to read a log, and there are many lines in each second,
+# so each distinct timestamp is only parsed once
+# The cache maps the timestamp text to the struct_time and the seconds since the epoch
+class Timestamps(object):
+	maxSize = 100000
+
+	def __init__(self):
+		self.cache = {}
+
+	def get(self, text):
+		t = self.cache.get(text)
+		if t is None:
+			if len(self.cache) >= self.maxSize:
+				self.cache.clear()
+			st = time.strptime(text, basics.format)
+			t = self.cache[text] = (st, time.mktime(st))
+		return t
+
+timestamps = Timestamps()
+
+childRe = re.compile(r'\(([0-9]+)\)')
+
+# The name and directory of a LOOKUP that failed, which can have spaces
+lookupRe = re.compile(r" LOOKUP '(.*)' in '(.*?)': ")
+
 # Get basic info for each line in the log
 # Line number, raw line text, timestamp
+# The line is classified by its first word, and only split into fields if something asks for them
+# (most lines are progress and warning lines that only need the first word of the message)
+# rest is the text of the fields, and head is the first field
 class Entry(object):
 	def __init__(self, line, i):
 		self.i = i
 		self.line = line
-
-		fields = line.split(' ')
+		# The name of the log file, when reading more than one
+		self.log = None
+		self.rest = line
+		self.head = ''
 		self.xcp = False
 		self.banner = False
 		self.child = None
 		self.warning = False
 		self.error = False
+		# 'dump', 'stats' or 'pending' for the rpc lines, which have no timestamp
+		self.channel = None
 
 		if not line:
 			return
 
-		# Most of the info we want is in lines that look like this:
-		# xcp 2019-11-04 13:48:20 xcp: [...]
-		if fields[0] == 'xcp':
-			# If it's a worker process, it also has the pid:
-			# xcp (1234) 2019-11-04 13:48:20 xcp: [...]
-			if re.match('\([0-9]+\)', fields[1]):
-				self.child = int(fields[1].lstrip('(').rstrip(')'))
-				fields = fields[1:]
-			try:
-				self.t = time.strptime(' '.join(fields[1:3]), basics.format)
-			except Exception as e:
-				print("xlog error line {i}: {line}: {e}".format(**vars()))
-				return
-			fields = fields[3:]
-			if fields[0] == 'xcp:' or ' '.join(fields[:2]) == 'xcp ERROR:':
-				self.xcp = True
-				fields = fields[1:]
-			elif ' WARNING: ' in line:
-				self.fields = fields
-				self.warning = Warning(self)
-				self.xcp = True
-
-		elif fields[0] == 'XCP':
-			# XCP 1.3-5f6c0b4; (c) 2019 NetApp, Inc.; Licensed to ...
-			self.banner = True
-		# These are miscellaneous kinds of lines in the log that we just ignore for now
-		# Here are examples from real logs, of what the following 'or ... or ... pass' code is ignoring
+		first, _, rest = line.partition(' ')
+		parse = self.parsers.get(first)
+		if parse:
+			parse(self, rest)
+		elif ' stats: {' in line:
+			# One line for each channel in a dump, e.g.
+			# 172.20.28.50 tcp 2049 nfs3 c0 (pending 0, sendq 0, slotq 0, closed False, reopenTask None) stats: {'replies received': 6628, 'partials': 204, 'moved': 38784, 'nospace': 0}
+			self.channel = 'stats'
+		# The rest are miscellaneous kinds of lines in the log that we just ignore for now
+		# Here are examples from real logs
 		# These are things like extra xcp diagnostic info, python stack tracebacks, nfs retries, etc:
-		#   172.20.28.50 tcp 2049 nfs3 c0 (pending 0, sendq 0, slotq 0, closed False, reopenTask None) stats: {'replies received': 6628, 'partials': 204, 'moved': 38784, 'nospace': 0}
 		#   Build date: Thu Sep 19 01:25:50 PDT 2019
-		#   pending xid 0x58a3d04c nfs3 MKDIR 'TJ3848500001' in 'mm2nv00201:/mm2c02s01p04/TG_DR7/dss_prod1_s2/dss/LB57/data/SICOMPLETED/DH20101021/PF384850' now 1555616052.83 duetime 1555616112.73 (59.9) self.lastCheck 1555616048.49 (-4.3) sched.getTime 1555616052.73 (-0.1)
 		#   File "nfs3.pyx", line 289, in nfs3.Client.setattr3 (nfs3.c:5646)
 		#   Failed with 'socket connect to 'edimaxfiler tcp 111 pmap2 c0': [Errno -2] Name or service not known'
 		# This utility to summarize the log certainly could understand and summarize all those things;
-		# but for now it ignores them:
-		elif len(fields) > 1 and (line[:16] == 'RPC channel dump' \
-		 or ' stats: {' in line \
-		 or fields[0] == 'Build' \
-		 or ' '.join(fields[:2]) == 'pending xid' \
-		 or 'File "' in ' '.join(fields[0:2]) \
-		 or fields[1] == 'setattr3()' \
-		 or ' '.join(fields[:2]) == '(c) 2019'\
-		 or ' '.join(fields[:4]) == 'Register for a license'\
-		 or "Failed with 'socket connect" in ' '.join(fields[0:5])):
-			pass
-		else:
-			#print('xlog: parser unimplemented; ignoring unknown line {i}: {line}'.format(**vars()))
-			pass
-		self.fields = fields
+		# but for now it ignores them
+
+	# Most of the info we want is in lines that look like this:
+	# xcp 2019-11-04 13:48:20 xcp: [...]
+	def parseXcp(self, rest):
+		# If it's a worker process, it also has the pid:
+		# xcp (1234) 2019-11-04 13:48:20 xcp: [...]
+		if rest[:1] == '(':
+			pid, _, more = rest.partition(' ')
+			if childRe.match(pid):
+				self.child = int(pid.lstrip('(').rstrip(')'))
+				rest = more
+		day, _, rest = rest.partition(' ')
+		hms, _, rest = rest.partition(' ')
+		try:
+			self.t, self.time = timestamps.get(day + ' ' + hms)
+		except Exception as e:
+			print("xlog error line {}: {}: {}".format(self.i, self.line, e))
+			return
+		self.rest = rest
+		word, _, more = rest.partition(' ')
+		if word == 'xcp:' or (word == 'xcp' and more.partition(' ')[0] == 'ERROR:'):
+			self.xcp = True
+			self.rest = more
+			self.head = more.partition(' ')[0]
+		elif ' WARNING: ' in self.line:
+			self.head = word
+			self.warning = Warning(self)
+			self.xcp = True
+
+	# XCP 1.3-5f6c0b4; (c) 2019 NetApp, Inc.; Licensed to ...
+	def parseBanner(self, rest):
+		self.banner = True
+
+	# RPC channel dump
+	def parseDump(self, rest):
+		if rest.startswith('channel dump'):
+			self.channel = 'dump'
+
+	# pending xid 0x58a3d04c nfs3 MKDIR 'TJ3848500001' in 'mm2nv00201:/mm2c02s01p04/TG_DR7/dss_prod1_s2/dss/LB57/data/SICOMPLETED/DH20101021/PF384850' now 1555616052.83 duetime 1555616112.73 (59.9) self.lastCheck 1555616048.49 (-4.3) sched.getTime 1555616052.73 (-0.1)
+	def parsePending(self, rest):
+		if rest.startswith('xid '):
+			self.channel = 'pending'
+
+	parsers = {
+		'xcp': parseXcp,
+		'XCP': parseBanner,
+		'RPC': parseDump,
+		'pending': parsePending,
+	}
+
+	@property
+	def fields(self):
+		fields = self.__dict__.get('_fields')
+		if fields is None:
+			fields = self._fields = self.rest.split(' ')
+		return fields
+
 	def __str__(self):
-		return ' '.join(self.fields)
+		return self.rest
 
 class Warning(object):
 	def __init__(self, entry):
@@ -152,9 +282,12 @@ class Warning(object):
 		if 'your license will expire' in entry.line:
 			self.ignore = True
 
-		line = ' '.join(self.entry.fields)
+		line = self.entry.rest
 
-		self.name = self.entry.fields[0] # cmpdir or compare1
+		self.name = self.entry.head # cmpdir or compare1
+		# The name in quotes before WARNING:, which is the last part of the path
+		quoted = line[len(self.name) + 1:].partition(' WARNING: ')[0]
+		self.fileName = quoted[1:-1] if len(quoted) > 1 and quoted[0] == quoted[-1] == "'" else None
 		if 'different attrs' in line:
 			# Line looks like one of these:
 			# cmpdir 'dirname' WARNING: 172.20.28.50:/NS/.snapshot/snapname/subdir/dirname: different attrs (Mtime)
@@ -162,7 +295,8 @@ class Warning(object):
 
 			# Category will look like
 			# 'cmpdir: (Owner,Group)' or 'compare1: (Mtime)'
-			self.x = self.entry.fields[3][:-1] # strip the : from the end
+			# The path can have spaces, so it's everything between the WARNING: and the : before different attrs
+			self.x = line.partition(' WARNING: ')[2].rpartition(': different attrs')[0]
 			attrs = self.entry.fields[-1]
 			self.whichAttrs = attrs[1:-1].split(',')
 			self.category = self.name + ': ' + self.entry.fields[-1]
@@ -172,11 +306,8 @@ class Warning(object):
 			# compare1 'filename' WARNING: (error) source file not found on target: nfs3 LOOKUP 'filename' in '172.20.28.55:/data/subdir': nfs3 error 2: no such file or directory
 
 			# 'compare1: not found'
-			i = self.entry.fields.index('LOOKUP')
-			fname = self.entry.fields[i+1][1:-1] # strip quotes
-			dname = self.entry.fields[i+3][1:-1]
-			dname = dname.rstrip("'")
-			self.x = dname + '/' + fname
+			m = lookupRe.search(line)
+			self.x = m and m.group(2) + '/' + m.group(1)
 			self.category = self.name + ': not found'
 		else:
 			self.x = None
@@ -184,8 +315,36 @@ class Warning(object):
 
 	@property
 	def text(self):
-		return ' '.join(self.entry.fields)
+		return self.entry.rest
+
+# The warnings of a command: the total (including ignored ones), the count for each category,
+# and the first few warnings of each category as examples
+class WarningSummary(object):
+	samples = 2
+
+	def __init__(self):
+		self.count = 0
+		self.counts = Counter()
+		self.examples = OrderedDict()
 
+	def add(self, warning):
+		self.count += 1
+		if warning.ignore:
+			return
+		self.counts[warning.category] += 1
+		examples = self.examples.setdefault(warning.category, [])
+		if len(examples) < self.samples:
+			examples.append(warning.text)
+
+	def __len__(self):
+		return self.count
+
+	def merge(self, other):
+		self.count += other.count
+		self.counts.update(other.counts)
+		for category, texts in other.examples.iteritems():
+			examples = self.examples.setdefault(category, [])
+			examples.extend(texts[:self.samples - len(examples)])
 
 # Recreate dictionaries from strings in the log that look like these:
 #  {-id: 'autoname_copy_2019-08-17_03.56.47.773764', -snap: '172.20.28.50:/NS/.snapshot/xcp_presync_11012019'}
@@ -204,7 +363,7 @@ class LoggedCommand(object):
 		self.name = entry.fields[1]
 		self.paths = []
 		self.idName = ''
-		self.warnings = []
+		self.warnings = WarningSummary()
 		if self.name == 'sync' and entry.fields[2] == 'dry-run':
 			self.name += '.dry-run'
 			self.cmdOptions = parseDict(' '.join(entry.fields[3:]))
@@ -213,8 +372,9 @@ class LoggedCommand(object):
 		logInfo.counts[self.name] += 1
 		self.key = '{}.{}'.format(self.name, logInfo.counts[self.name])
 		logInfo.commands[self.key] = self
-		self.entries = [entry]
-		self.entry = self.entries[0]
+		# The first and the latest entries of the command
+		self.entry = entry
+		self.last = entry
 		# It is hard to determine if there was a fatal error
 		# because the log is so messy; however we try to do it
 		# by looking at the last few log entries.  This method
@@ -226,40 +386,67 @@ class LoggedCommand(object):
 
 		# For verify, figure out if it matches the source and target of a copy or sync
 		self.match = None
+		self.reversed = False
 
-		# How long ago did the command start
-		self.age = basics.getAge(
-			datetime.datetime.now(),
-			datetime.datetime.fromtimestamp(time.mktime(self.entry.t)),
-		)
-		# We'll calculate duration from the last log entry
+		# How long ago the command started and its duration are calculated after parsing
+		# (the command might have been parsed by an earlier run and saved in the parse cache)
+		self.age = ''
 		self.duration = ''
 
-	def checkid(self):
-		# Find out if the verify exactly matches the
-		# source and target of a copy or a sync,
-		# or a sync -snap and its target,
-		# or a reverse-verify match for one of the above
-		if self.name == 'verify':
-			# TODO: this is a quadratic algorithm; fix that
-			for cmd in self.logInfo.commands.values():
-				if cmd.name not in ('copy', 'sync') \
-				 or cmd.entry.i >= self.entry.i:
-					# Don't look at commands that came after this one
-					break
+	def setIndex(self, index):
+		self.index = index
 
-				if not cmd.index:
-					continue
-				source = cmd.index['source']
-				target = cmd.index.get('target')
-				if '-snap' in cmd.cmdOptions:
-					source = cmd.cmdOptions['-snap']
-				if source == self.paths[0] and target == self.paths[1]:
-					self.match = cmd
-					self.reversed = False
-				elif source == self.paths[1] and target == self.paths[0]:
-					self.match = cmd
-					self.reversed = True
+		# The log has this 'Index:' line because either -id or -newid was used
+		# So get the id name out from the options
+		self.idName = self.cmdOptions.get('-newid') or self.cmdOptions['-id']
+		self.logInfo.indexes[self.idName] = self.index
+
+	# Called for the first 'Engine info:' entry of the command
+	# The log entry before it should either be the final stats line or an error
+	def setStatus(self, last):
+		if last.head == 'ERROR:':
+			self.failure = last
+		else:
+			self.finalStatus = last
+
+	# Add base to the line numbers of the entries, for a command parsed from a range of the log
+	def renumber(self, base):
+		entries = {id(e): e for e in (self.entry, self.last, self.failure, self.finalStatus) if isinstance(e, Entry)}
+		for e in entries.values():
+			e.i += base
+
+	# The (source, target) pair of a copy or sync, for matching verifies
+	# For a sync -snap, the source is the snapshot
+	def pair(self):
+		if self.name not in ('copy', 'sync') or not self.index:
+			return None
+		source = self.index['source']
+		if '-snap' in self.cmdOptions:
+			source = self.cmdOptions['-snap']
+		return (source, self.index.get('target'))
+
+	# Find out if the verify exactly matches the
+	# source and target of a copy or a sync,
+	# or a sync -snap and its target,
+	# or a reverse-verify match for one of the above
+	# pairs maps each (source, target) to the latest copy or sync before this command;
+	# the commands are checked in order, so it only has the ones that came before
+	# n is the position of this command in the log, and pairs has (n, command) for each pair
+	def checkid(self, pairs, n):
+		pair = self.pair()
+		if pair:
+			pairs[pair] = (n, self)
+		if self.name != 'verify' or len(self.paths) < 2:
+			return
+		forward = pairs.get((self.paths[0], self.paths[1]))
+		backward = pairs.get((self.paths[1], self.paths[0]))
+		# If both match, the latest one wins
+		if forward and (not backward or forward[0] > backward[0]):
+			self.match = forward[1]
+			self.reversed = False
+		elif backward:
+			self.match = backward[1]
+			self.reversed = True
 
 	# console format for summary line
 	def wcountstr(self):
@@ -306,11 +493,16 @@ class LoggedCommand(object):
 			if self.match:
 				k = self.reversed and (self.match.key + ' reversed') or self.match.key
 				s += "(src+target match {})".format(k)
+			elif long:
+				s += "(no copy or sync with the same src+target)"
 
 		if '-snap' in self.cmdOptions:
 			s += delim + "-snap {}".format(self.cmdOptions['-snap'])
 		if self.logInfo.options.chose(lineNumbersOption):
-			s = '{}: '.format(self.entry.i) + s
+			if self.entry.log:
+				s = '{}:{}: '.format(self.entry.log, self.entry.i) + s
+			else:
+				s = '{}: '.format(self.entry.i) + s
 		if long:
 			s += delim + str(self.failure or self.finalStatus)
 
@@ -319,13 +511,913 @@ class LoggedCommand(object):
 	def __str__(self):
 		return self.fmt()
 
+# Iterates over the complete lines of the log from a byte offset, up to end if it's not None
+# offset is the end of the last line returned, and count is the number of lines
+# A line at the end without a newline may still be written, so it's only returned with partial
+class LineReader(object):
+	chunk = 1 << 20
+
+	def __init__(self, f, offset=0, end=None, partial=False):
+		self.f = f
+		self.offset = offset
+		self.end = end
+		self.count = 0
+		self.partial = partial
+
+	def __iter__(self):
+		self.f.seek(self.offset)
+		pos = self.offset
+		rest = ''
+		while True:
+			n = self.chunk
+			if self.end is not None:
+				n = min(n, self.end - pos)
+			data = n > 0 and self.f.read(n)
+			if not data:
+				# With partial, the last line is yielded even if it has no newline, e.g. the last line of a run that crashed;
+				# it is not counted in offset and count, so the parse cache reads it again when it is complete
+				if self.partial and rest:
+					yield rest
+				return
+			pos += len(data)
+			lines = (rest + data).split('\n')
+			rest = lines.pop()
+			for line in lines:
+				self.offset += len(line) + 1
+				self.count += 1
+				yield line
+
+# Generator for the interesting entries in the log; first is the line number of the first line
+# With channels, the rpc channel dumps are included too, with the time of the entry before them
+def readEntries(lines, first=1, channels=False):
+	last = None
+	for i, line in enumerate(lines, first):
+		e = Entry(line.strip(), i)
+		if e.xcp and e.rest:
+			last = e.time
+			yield e
+		elif channels and e.channel:
+			e.time = last
+			yield e
+
+# Parses the entries one at a time to identify commands
+# The current command and whether its 'Engine info:' has been seen are the only state between entries
+class LogParser(object):
+	def __init__(self, logInfo):
+		self.logInfo = logInfo
+		self.cmd = None
+		self.engineInfo = None
+		# For a worker's parser, the ContinuedCommand for the command in progress at the start of its range
+		self.continued = None
+		# For -db, -osfix and -timeline, these get each entry of a command as it is parsed
+		self.sinks = []
+
+	def add(self, e):
+		cmd = self.cmd
+		if e.channel:
+			# The channel dumps are only for the sinks; they are not part of the command
+			if cmd:
+				for sink in self.sinks:
+					sink.add(cmd, e)
+			return
+
+		if e.head == 'Command:':
+			# Example
+			# xcp 2019-11-04 18:52:02 xcp: Command: scan {-id: 'autoname_copy_2019-08-17_03.56.47.773764', -match: 'x.getPath()==1'}
+			cmd = self.cmd = LoggedCommand(e, self.logInfo)
+			self.engineInfo = None
+
+		elif e.head == 'Paths:':
+			# Example
+			# xcp 2019-11-04 16:37:11 xcp: Paths: ['172.20.28.50:/NS/.snapshot/xcp_presync_11012019', '172.20.28.55:/data']
+			cmd.paths = eval(''.join(e.fields[1:3]))
+
+		elif e.warning:
+			if cmd:
+				cmd.warnings.add(e.warning)
+
+		elif e.head == 'Index:':
+			# The index has the source and target (or just source for a scan-only index)
+			# Example
+			# xcp 2019-11-04 18:52:02 xcp: Index: {source: 172.20.28.50:/NS, target: 172.20.28.55:/data}
+
+			# Note that for sync and sync dry-run, there could 
+			# be a -snap option which is the latest source.  
+			# In that case this index 'source' logged here is the original baseline copy source
+			cmd.setIndex(parseDict(' '.join(e.fields[1:])))
+
+		elif e.head == 'main:' and e.fields[3] == 'runid':
+			# This is the start of a new command; its 'Command:' entry is coming up
+			# Example
+			# xcp 2019-11-04 18:52:02 main: pid 12502 runid 890747532820843
+			cmd = self.cmd = None
+			self.engineInfo = None
+
+		elif cmd and not self.engineInfo and (e.rest == 'Engine info:' or e.rest.startswith('Engine info: ')):
+			# When we see 'Engine info:' the first time it is the beginning of the end
+			# The log entry before it should either be the final stats line or an error
+			# This is obviously a very brittle kludgy way to determine if it failed,
+			# and it is my fault for allowing the log to be so inconsistent and messy
+			# Anyway this seems to work but certainly needs more validation
+			cmd.setStatus(cmd.last)
+			self.engineInfo = 1
+
+		if cmd:
+			cmd.last = e
+			for sink in self.sinks:
+				sink.add(cmd, e)
+
+	# Add the results of a worker's parser for the next range of the log
+	# base is the number of lines before the range
+	def stitch(self, other, base):
+		cont = other.continued
+		cmd = self.cmd
+		if cmd:
+			# Whatever the worker found before the first command in its range belongs to our current command
+			cont.renumber(base)
+			if cont.paths is not None:
+				cmd.paths = cont.paths
+			cmd.warnings.merge(cont.warnings)
+			if cont.index is not None:
+				cmd.setIndex(cont.index)
+			if cont.status and not self.engineInfo:
+				cmd.setStatus(cont.status[0] or cmd.last)
+			if cont.last:
+				cmd.last = cont.last
+		if other.cmd is cont:
+			# No new command started in the range
+			self.engineInfo = self.engineInfo or other.engineInfo
+		else:
+			self.cmd = other.cmd
+			self.engineInfo = other.engineInfo
+
+		for cmd in other.logInfo.commands.values():
+			cmd.renumber(base)
+			cmd.logInfo = self.logInfo
+			self.logInfo.counts[cmd.name] += 1
+			cmd.key = '{}.{}'.format(cmd.name, self.logInfo.counts[cmd.name])
+			self.logInfo.commands[cmd.key] = cmd
+		for name, index in other.logInfo.indexes.iteritems():
+			self.logInfo.indexes[name] = index
+
+	# After all the entries, a few more loops through the commands are done to get some extra info
+	def finish(self):
+		# Get how long ago each command started, and its duration
+		# getAge was written to display modification times; that's why it's called "Age";
+		# in this case we are using to show human readable command duration like "15h18m"
+		now = datetime.datetime.now()
+		pairs = {}
+		for n, cmd in enumerate(self.logInfo.commands.values()):
+			cmd.age = basics.getAge(now, datetime.datetime.fromtimestamp(cmd.entry.time))
+			cmd.duration = basics.getAge(
+				datetime.datetime.fromtimestamp(cmd.entry.time),
+				datetime.datetime.fromtimestamp(cmd.last.time)
+			)
+			cmd.checkid(pairs, n)
+
+		for cmd in self.logInfo.commands.values():
+			assert cmd.duration[0] == '+', "internal error: invalid duration calculation: {}".format(cmd.duration[0])
+			# the getAge expects negatives so it adds a + which we don't want here
+			cmd.duration = cmd.duration.strip('+')
+
+# The log's identity for the parse cache: its inode, size and mtime, and a hash of the bytes before offset
+# The hash is there because a log that was rotated by copying and truncating has the same inode,
+# and could have grown past the offset again by the next run
+def logIdentity(f, offset):
+	st = os.fstat(f.fileno())
+	start = max(0, offset - 4096)
+	f.seek(start)
+	tail = hashlib.md5(f.read(offset - start)).hexdigest()
+	return {'ino': st.st_ino, 'size': st.st_size, 'mtime': st.st_mtime, 'tail': tail}
+
+cacheDir = os.path.expanduser('~/.xlogcache')
+
+# The cache file for a log, named for the log's file name and a hash of its full path
+def parseCachePath(logPath):
+	path = os.path.realpath(logPath)
+	return os.path.join(cacheDir, '{}.{}'.format(os.path.basename(path), hashlib.md5(path).hexdigest()[:16]))
+
+# Loading a pickle can run code, so only files and directories that nobody else could have written are trusted
+def private(st):
+	return st.st_uid == os.geteuid() and not st.st_mode & 022
+
+# Returns the saved (parser, offset, lines) if the cache is for the log, which could have been appended to
+def loadParseCache(cachePath, f):
+	try:
+		if not private(os.stat(cacheDir)):
+			print("not using the parse cache: {} can be written by others".format(cacheDir))
+			return None
+		with open(cachePath, 'rb') as cf:
+			if not private(os.fstat(cf.fileno())):
+				print("not using the parse cache: {} can be written by others".format(cachePath))
+				return None
+			cache = cPickle.load(cf)
+	except Exception:
+		return None
+	if cache.get('version') != cacheVersion:
+		return None
+	saved = cache['log']
+	offset = cache['offset']
+	current = logIdentity(f, offset)
+	if current['ino'] != saved['ino'] or current['size'] < offset or current['tail'] != saved['tail']:
+		return None
+	if current['size'] == saved['size'] and current['mtime'] != saved['mtime']:
+		# Same size but rewritten
+		return None
+	return cache['parser'], offset, cache['lines']
+
+def saveParseCache(cachePath, f, parser, offset, lines):
+	cache = {
+		'version': cacheVersion,
+		'log': logIdentity(f, offset),
+		'offset': offset,
+		'lines': lines,
+		'parser': parser,
+	}
+	try:
+		if not os.path.isdir(cacheDir):
+			os.mkdir(cacheDir, 0700)
+		if not private(os.stat(cacheDir)):
+			print("not saving the parse cache: {} can be written by others".format(cacheDir))
+			return
+		fd = os.open(cachePath + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+		with os.fdopen(fd, 'wb') as cf:
+			cPickle.dump(cache, cf, cPickle.HIGHEST_PROTOCOL)
+		os.rename(cachePath + '.tmp', cachePath)
+	except (IOError, OSError) as e:
+		print("not saving the parse cache: {}".format(e))
+
+# Stands in for the command that was in progress at the start of a range of the log parsed by a worker
+# It just collects what the parser finds for the command, for LogParser.stitch
+class ContinuedCommand(object):
+	def __init__(self):
+		self.paths = None
+		self.index = None
+		self.warnings = WarningSummary()
+		self.last = None
+		# The entry before the first 'Engine info:' in a tuple, with None if it was before the range
+		self.status = None
+
+	def setIndex(self, index):
+		self.index = index
+
+	def setStatus(self, last):
+		self.status = (last,)
+
+	def renumber(self, base):
+		entries = {id(e): e for e in (self.last, self.status and self.status[0]) if isinstance(e, Entry)}
+		for e in entries.values():
+			e.i += base
+
+# Returns the byte ranges for parsing the log in parallel, starting and ending at line boundaries
+# The last range goes to the end of the file, but LineReader stops at the last complete line
+def splitLog(f, start, size, n):
+	bounds = [start]
+	for i in xrange(1, n):
+		f.seek(start + (size - start) * i / n)
+		f.readline()
+		pos = f.tell()
+		if bounds[-1] < pos < size:
+			bounds.append(pos)
+	bounds.append(size)
+	return zip(bounds[:-1], bounds[1:])
+
+# Parses a range of the log in a worker process
+# The results are the parser, the offset of the end of the last complete line, and the number of lines
+class ParseRange(sched.Task):
+	def __init__(self, logPath, start, end, resTube):
+		self.resTube = resTube
+		self.start = start
+		producer = self.gRun(logPath, start, end)
+		super(ParseRange, self).__init__(logPath, start, end, producer=producer, process=True)
+
+	# This runs in the parent process to get the results from the child
+	def cfun(self, result):
+		self.resTube.send((self.start, result))
+
+	def gRun(self, logPath, start, end):
+		self.name = "parse {} bytes {}-{}".format(logPath, start, end)
+		if 0:
+			yield
+
+		parser = LogParser(LogInfo(None))
+		parser.cmd = parser.continued = ContinuedCommand()
+		with open(logPath, 'rb') as f:
+			reader = LineReader(f, start, end)
+			for e in readEntries(reader):
+				parser.add(e)
+		self.results = (parser, reader.offset, reader.count)
+
+# Writes the commands and warnings to a new SQLite database for -db
+# The warnings are inserted in batches as they are parsed; the commands, paths and indexes at the end.
+# The indexes on the tables are created after all the rows are in, which is much faster than updating them
+# The database is written to a temporary file which replaces the path at the end,
+# and an existing file at the path is only replaced if it's a database from an earlier -db
+class DbExport(object):
+	batchSize = 10000
+
+	tables = [
+		'create table commands (key text primary key, name text, line integer, started real, duration text, '
+			'failed integer, status text, idname text, snap text, warnings integer, match text, reversed integer)',
+		'create table paths (command text, n integer, path text)',
+		'create table indexes (name text primary key, source text, target text)',
+		'create table warnings (command text, log text, line integer, name text, category text, path text, '
+			'attrs text, text text)',
+	]
+	indexes = [
+		'create index commands_name on commands (name)',
+		'create index paths_command on paths (command)',
+		'create index paths_path on paths (path)',
+		'create index warnings_command on warnings (command)',
+		'create index warnings_category on warnings (category)',
+		'create index warnings_path on warnings (path)',
+	]
+
+	def __init__(self, path):
+		self.path = path
+		if os.path.exists(path) and not self.isExport(path):
+			raise sched.ShortError('{} exists and is not a database exported by xlog -db'.format(path))
+		self.tmpPath = '{}.{}.tmp'.format(path, os.getpid())
+		os.close(os.open(self.tmpPath, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0666))
+		self.db = sqlite3.connect(self.tmpPath)
+		self.db.text_factory = str
+		self.db.execute('pragma synchronous = off')
+		self.db.execute('pragma journal_mode = off')
+		for sql in self.tables:
+			self.db.execute(sql)
+		self.warnings = []
+		self.nwarnings = 0
+
+	@classmethod
+	def isExport(cls, path):
+		with open(path, 'rb') as f:
+			if f.read(16) != 'SQLite format 3\0':
+				return False
+		db = sqlite3.connect(path)
+		try:
+			names = set(row[0] for row in db.execute("select name from sqlite_master where type = 'table'"))
+		except sqlite3.Error:
+			return False
+		finally:
+			db.close()
+		return names == set(sql.split()[2] for sql in cls.tables)
+
+	def add(self, cmd, e):
+		w = e.warning
+		if not w or w.ignore:
+			return
+		self.warnings.append((cmd.key, e.log, e.i, w.name, w.category, w.x, w.whichAttrs and ','.join(w.whichAttrs), w.text))
+		if len(self.warnings) >= self.batchSize:
+			self.flush()
+
+	def flush(self):
+		with self.db:
+			self.db.executemany('insert into warnings values (?, ?, ?, ?, ?, ?, ?, ?)', self.warnings)
+		self.nwarnings += len(self.warnings)
+		self.warnings = []
+
+	def finish(self, logInfo):
+		self.flush()
+		with self.db:
+			self.db.executemany('insert into commands values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', [(
+				cmd.key, cmd.name, cmd.entry.i, cmd.entry.time, cmd.duration, cmd.failure and 1 or 0,
+				str(cmd.failure or cmd.finalStatus or ''), cmd.idName or None, cmd.cmdOptions.get('-snap'),
+				len(cmd.warnings), cmd.match and cmd.match.key, cmd.match and int(cmd.reversed))
+				for cmd in logInfo.commands.values()])
+			self.db.executemany('insert into paths values (?, ?, ?)',
+				[(cmd.key, n, path) for cmd in logInfo.commands.values() for n, path in enumerate(cmd.paths)])
+			self.db.executemany('insert into indexes values (?, ?, ?)',
+				[(name, d['source'], d.get('target')) for name, d in logInfo.indexes.items()])
+		for sql in self.indexes:
+			self.db.execute(sql)
+		self.db.commit()
+		self.db.close()
+		os.rename(self.tmpPath, self.path)
+		print("exported {} commands, {} indexes and {} warnings to {}".format(
+			len(logInfo.commands), len(logInfo.indexes), self.nwarnings, self.path))
+
+# The path relative to the source or target of the command, or None if it is not under either
+def relativePath(cmd, path):
+	for root in cmd.paths:
+		root = root.rstrip('/')
+		if path == root or path.startswith(root + '/'):
+			return path[len(root):].lstrip('/')
+	return None
+
+# Writes the -osfix script for the warnings of one command as they are parsed
+# Consecutive warnings in the same directory (verify reports a directory's entries together) are kept
+# until the directory changes, and then written as a loop over the names for each kind of fix
+# The touches are written last, deepest directories first, since copying into a directory changes its mtime;
+# until then each group's touches are kept in a temporary file for the depth of its directory
+class OsFix(object):
+	# Write a directory's fixes when it has this many, even if more are coming
+	maxGroup = 1000
+
+	# The fix for each attribute in a 'different attrs' warning
+	attrFixes = {
+		'Size': 'copy',
+		'Owner': 'chown',
+		'Uid': 'chown',
+		'Group': 'chown',
+		'Gid': 'chown',
+		'Mode': 'chmod',
+		'Mtime': 'touch',
+	}
+
+	# The fixes in the order they are done, and the command for each name $f in directory $d
+	# Copying with cp -p also sets the owner, mode and times, so the other fixes are not needed after a copy
+	fixes = [
+		('copy', 'cp -pR "$S/$d/$f" "$T/$d/"'),
+		('chown', 'chown --reference="$S/$d/$f" "$T/$d/$f"'),
+		('chmod', 'chmod --reference="$S/$d/$f" "$T/$d/$f"'),
+		('touch', 'touch -m -r "$S/$d/$f" "$T/$d/$f"'),
+	]
+
+	def __init__(self, key, path):
+		self.key = key
+		self.path = path
+		self.f = open(path, 'w')
+		self.started = False
+		self.dir = None
+		self.group = []
+		self.counts = Counter()
+		# depth -> temporary file of pickled (directory, names) for the touches
+		self.touches = {}
+
+	def header(self, cmd):
+		self.started = True
+		source, target = (cmd.paths + ['', ''])[:2]
+		self.f.write("#!/bin/sh\n"
+			"# Commands to fix the differences found by {} ({} {})\n"
+			"# Set S to the local mount of {} and T to the local mount of {}\n"
+			": ${{S:?}} ${{T:?}}\n".format(self.key, source, target, source, target))
+
+	def add(self, cmd, e):
+		w = e.warning
+		if not w or cmd.key != self.key:
+			return
+		if not self.started:
+			self.header(cmd)
+		if w.ignore:
+			return
+		if w.name == 'compare1' and 'source file not found' in w.text:
+			fixes = set(['copy'])
+		elif w.whichAttrs:
+			# A directory's size depends on the filesystem, so it's not a difference to fix
+			attrs = [a for a in w.whichAttrs if not (w.name == 'cmpdir' and a == 'Size')]
+			if not attrs:
+				return
+			fixes = set(self.attrFixes.get(a) for a in attrs)
+		else:
+			fixes = set([None])
+
+		# The path has to end with the name in the warning, or the fix could be for the wrong file
+		rel = w.x and relativePath(cmd, w.x)
+		if None in fixes or not rel or posixpath.basename(rel) != w.fileName:
+			self.counts['unhandled'] += 1
+			self.f.write("# not fixed (line {}): {}\n".format(e.i, w.text))
+			return
+		if 'copy' in fixes:
+			fixes = set(['copy'])
+
+		d, name = posixpath.split(rel)
+		if d != self.dir or len(self.group) >= self.maxGroup:
+			self.flush()
+			self.dir = d
+		self.group.append((name, fixes))
+
+	def flush(self):
+		if not self.group:
+			return
+		touches = [name for name, fixes in self.group if 'touch' in fixes]
+		if touches:
+			self.counts['touch'] += len(touches)
+			depth = self.dir.count('/') + bool(self.dir)
+			if depth not in self.touches:
+				self.touches[depth] = tempfile.TemporaryFile()
+			cPickle.dump((self.dir, touches), self.touches[depth], cPickle.HIGHEST_PROTOCOL)
+		loops = []
+		for fix, command in self.fixes:
+			names = [name for name, fixes in self.group if fix in fixes]
+			if names and fix != 'touch':
+				self.counts[fix] += len(names)
+				loops.append("for f in {}; do {}; done\n".format(' '.join(pipes.quote(n) for n in names), command))
+		if loops:
+			self.f.write("d={}\n".format(pipes.quote(self.dir or '.')))
+			self.f.writelines(loops)
+		self.group = []
+
+	# Reads back one group at a time; a directory's groups (which verify reports together) are joined up to maxGroup names
+	def writeTouches(self):
+		command = dict(self.fixes)['touch']
+		def write(names):
+			if names:
+				self.f.write("for f in {}; do {}; done\n".format(' '.join(pipes.quote(n) for n in names), command))
+		for depth in sorted(self.touches, reverse=True):
+			f = self.touches[depth]
+			f.seek(0)
+			last, pending = None, []
+			while True:
+				try:
+					d, names = cPickle.load(f)
+				except EOFError:
+					break
+				if d != last:
+					write(pending)
+					pending = []
+					self.f.write("d={}\n".format(pipes.quote(d or '.')))
+					last = d
+				elif len(pending) + len(names) > self.maxGroup:
+					write(pending)
+					pending = []
+				pending.extend(names)
+			write(pending)
+			f.close()
+		self.touches = {}
+
+	def finish(self, logInfo):
+		self.flush()
+		self.writeTouches()
+		self.f.close()
+		if not self.started:
+			os.remove(self.path)
+			return
+		print("wrote {} with {} copies, {} chowns, {} chmods and {} touches; {} warnings not fixed".format(self.path,
+			self.counts['copy'], self.counts['chown'], self.counts['chmod'], self.counts['touch'], self.counts['unhandled']))
+
+# The units of the sizes in the progress lines
+sizeUnits = {'B': 1, 'KiB': 1 << 10, 'MiB': 1 << 20, 'GiB': 1 << 30, 'TiB': 1 << 40, 'PiB': 1 << 50}
+
+countRe = re.compile(r'(?:^|: )([0-9][0-9,]*) ([a-z][a-z ]*)$')
+sizeRe = re.compile(r'^([0-9.]+) ([KMGTP]?i?B) (in|out)(?: \(([0-9.]+) ([KMGTP]?i?B)/s\))?$')
+channelRe = re.compile(r'^(.*?) \(pending ([0-9]+), sendq ([0-9]+)')
+
+# The counts and sizes in a progress line, e.g.
+# 12,345 scanned, 6,789 copied, 1.2 MiB in (250 KiB/s), 3 MiB out (500 KiB/s), 5s
+def parseProgress(text):
+	sample = {}
+	for part in text.split(', '):
+		m = countRe.search(part)
+		if m:
+			sample[m.group(2)] = int(m.group(1).replace(',', ''))
+			continue
+		m = sizeRe.match(part)
+		if m and m.group(2) in sizeUnits:
+			number, unit, direction, rate, rateUnit = m.groups()
+			sample[direction] = int(float(number) * sizeUnits[unit])
+			if rate and rateUnit in sizeUnits:
+				sample[direction + '/s'] = int(float(rate) * sizeUnits[rateUnit])
+	return sample
+
+# The name, pending and send queue depths, and replies received of a channel in a dump
+def parseChannel(line):
+	m = channelRe.match(line)
+	if not m:
+		return None
+	try:
+		stats = ast.literal_eval(line.partition(' stats: ')[2])
+	except (ValueError, SyntaxError):
+		stats = {}
+	return m.group(1), (int(m.group(2)), int(m.group(3)), stats.get('replies received'))
+
+# Collects the -timeline of one command as it is parsed
+# There is a row for each progress line, with the counts and sizes, and a row for each rpc channel dump,
+# with the replies and queue depths added up for all the channels; a row only has the columns its line had
+# The rates are worked out between the rows that have the column; xcp's own rates for in and out are kept
+class Timeline(object):
+	columns = ['time', 'elapsed', 'scanned', 'scanned/s', 'copied', 'copied/s', 'in', 'in/s', 'out', 'out/s',
+		'replies', 'replies/s', 'pending', 'sendq']
+	# The running totals that get a rate
+	totals = ['scanned', 'copied', 'in', 'out', 'replies']
+	sizes = ['in', 'in/s', 'out', 'out/s']
+
+	def __init__(self, key, path):
+		self.key = key
+		self.path = path
+		self.cmd = None
+		self.time = None
+		# The channels of the dump being read
+		self.dump = None
+		self.rows = []
+
+	def add(self, cmd, e):
+		if cmd.key != self.key:
+			return
+		self.cmd = cmd
+		if e.channel == 'pending':
+			return
+		if e.channel == 'stats':
+			channel = parseChannel(e.line)
+			if channel:
+				if self.dump is None:
+					self.dump = {}
+				name, values = channel
+				self.dump[name] = values
+			return
+		# The dump ends at the next header or timestamped entry
+		if self.dump:
+			self.addDump()
+		if e.channel == 'dump':
+			self.dump = {}
+			return
+
+		self.time = e.time
+		if 'scanned' in e.rest:
+			sample = parseProgress(e.rest)
+			if sample:
+				sample['time'] = e.time
+				self.rows.append(sample)
+
+	def addDump(self):
+		channels = self.dump.values()
+		replies = [r for p, q, r in channels if r is not None]
+		self.rows.append({
+			'time': self.time,
+			'pending': sum(p for p, q, r in channels),
+			'sendq': sum(q for p, q, r in channels),
+			'replies': sum(replies) if replies else None,
+		})
+		self.dump = None
+
+	def finish(self, logInfo):
+		if self.dump:
+			self.addDump()
+		if not self.cmd:
+			return
+		start = self.cmd.entry.time
+		last = {}
+		for row in self.rows:
+			t = row['time']
+			for column in self.totals:
+				v = row.get(column)
+				if v is None or column + '/s' in row:
+					continue
+				if column in last:
+					pt, pv = last[column]
+					if t <= pt:
+						continue
+					if v >= pv:
+						row[column + '/s'] = int((v - pv) / (t - pt))
+				last[column] = (t, v)
+			row['elapsed'] = int(t - start)
+
+	def write(self):
+		path = self.path
+		rows = [OrderedDict((column, row.get(column)) for column in self.columns) for row in self.rows]
+		for row in rows:
+			row['time'] = time.strftime(basics.format, time.localtime(row['time']))
+
+		if path and path.endswith('.json'):
+			with open(path, 'w') as f:
+				json.dump(rows, f, indent=1)
+		elif path:
+			with open(path, 'wb') as f:
+				writer = csv.writer(f)
+				writer.writerow(self.columns)
+				for row in rows:
+					writer.writerow(['' if v is None else v for v in row.values()])
+		else:
+			table = [self.columns]
+			for row in rows:
+				table.append([self.formatValue(column, v) for column, v in row.items()])
+			widths = [max(len(r[n]) for r in table) for n in range(len(self.columns))]
+			for r in table:
+				print('  '.join(v.rjust(w) for v, w in zip(r, widths)))
+			return
+		print("wrote {} rows to {}".format(len(rows), path))
+
+	def formatValue(self, column, v):
+		if v is None:
+			return ''
+		if column in self.sizes:
+			return basics.formatSize(v)
+		if isinstance(v, int):
+			return '{:,}'.format(v)
+		return str(v)
+
+pendingRe = re.compile(r"^pending xid (\S+) (\S+) (\S+) '(.*?)'(?: in '(.*?)')? now ([0-9.]+) duetime ([0-9.]+)")
+
+def percentile(values, p):
+	return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+# Collects the 'pending xid' lines of one command for -pending
+# xcp logs the same rpc each time it checks on it while it is still pending, so only the last line for each rpc is kept;
+# the report ranks the servers, the nfs procedures and the directory subtrees by their total time overdue
+# A line with now before duetime is for an rpc that is not late yet (the number in parentheses is the time left),
+# so it is only counted
+class PendingReport(object):
+	# Directories are grouped by this many levels below the source or target of the command
+	subtreeDepth = 2
+	top = 10
+	percentiles = [50, 90, 99]
+
+	def __init__(self, key):
+		self.key = key
+		self.cmd = None
+		self.lines = 0
+		self.notDue = 0
+		# (xid, name, directory) -> (server, procedure, subtree, seconds overdue)
+		self.rpcs = {}
+
+	def add(self, cmd, e):
+		if cmd.key != self.key or e.channel != 'pending':
+			return
+		self.cmd = cmd
+		m = pendingRe.match(e.line)
+		if not m:
+			return
+		self.lines += 1
+		xid, program, procedure, name, path, now, duetime = m.groups()
+		overdue = float(now) - float(duetime)
+		if overdue <= 0:
+			self.notDue += 1
+			return
+		server = path.partition(':')[0] if path else '(unknown)'
+		self.rpcs[xid, name, path] = (server, program + ' ' + procedure, self.subtree(cmd, path), overdue)
+
+	def subtree(self, cmd, path):
+		if not path:
+			return '(unknown)'
+		rel = relativePath(cmd, path)
+		if rel is None:
+			# Not under the source or target; group by the export and the first levels below it
+			server, _, rel = path.partition(':')
+			return '{}:/{}'.format(server, '/'.join(rel.strip('/').split('/')[:self.subtreeDepth + 1]))
+		return '/'.join(rel.split('/')[:self.subtreeDepth]) or '.'
+
+	def finish(self, logInfo):
+		pass
+
+	def rank(self, n):
+		groups = {}
+		for rpc in self.rpcs.values():
+			groups.setdefault(rpc[n], []).append(rpc[3])
+		rows = []
+		for name, overdue in groups.items():
+			overdue.sort()
+			rows.append([name, len(overdue), sum(overdue)] +
+				[percentile(overdue, p) for p in self.percentiles] + [overdue[-1]])
+		rows.sort(key=lambda r: (-r[2], -r[1], r[0]))
+		return rows[:self.top]
+
+	def write(self):
+		print("{} pending lines ({} not yet due) for {} overdue rpcs".format(self.lines, self.notDue, len(self.rpcs)))
+		if not self.rpcs:
+			return
+		for title, n in (('servers', 0), ('procedures', 1), ('subtrees', 2)):
+			header = [title, 'count', 'overdue'] + ['p{}'.format(p) for p in self.percentiles] + ['max']
+			table = [header] + [[r[0], '{:,}'.format(r[1])] + ['{:.1f}s'.format(x) for x in r[2:]] for r in self.rank(n)]
+			widths = [max(len(r[i]) for r in table) for i in range(len(header))]
+			print
+			for r in table:
+				print('  '.join([r[0].ljust(widths[0])] + [v.rjust(w) for v, w in zip(r[1:], widths[1:])]))
+
+# Expand the -f list of logs and patterns; patterns that match nothing are kept, so opening them fails
+def logPaths(spec):
+	paths = []
+	for pattern in spec.split(','):
+		for path in sorted(glob.glob(pattern)) or [pattern]:
+			if path not in paths:
+				paths.append(path)
+	return paths
+
+def openLog(path):
+	if path.endswith('.gz'):
+		return gzip.open(path, 'rb')
+	return open(path, 'rb')
+
+# Generator for the entries of several logs, merged by timestamp, with the number of the log each one is from
+# Entries with the same timestamp stay in the order of the logs on the command line, and their order in each log
+def mergeEntries(paths, channels=False):
+	def stream(n, f):
+		for e in readEntries(LineReader(f, partial=True), channels=channels):
+			yield e.time, n, e.i, e
+
+	files = [openLog(path) for path in paths]
+	try:
+		streams = [stream(n, f) for n, f in enumerate(files)]
+		name = os.path.basename
+		for t, n, i, e in heapq.merge(*streams):
+			e.log = name(paths[n])
+			yield n, e
+	finally:
+		for f in files:
+			f.close()
+
+# Ranges smaller than this are not worth a worker
+minRangeSize = 8 << 20
+
+# A synthetic log for -benchmark with the usual mix of lines: a few commands, each with progress lines,
+# verify warnings, worker process lines, and stats and traceback lines which are ignored
+def syntheticLog(n):
+	templates = [
+		"xcp {t} xcp: 12,345 scanned, 6,789 copied, 1.2 MiB in (250 KiB/s), 3 MiB out (500 KiB/s), 5s",
+		"xcp {t} cmpdir 'd{i}' WARNING: 10.0.0.1:/vol/a/d{i}: different attrs (Mtime)",
+		"xcp (1234) {t} compare1 'f{i}' WARNING: 10.0.0.1:/vol/b/f{i}: different attrs (Mtime,Size)",
+		"xcp {t} compare1 'f{i}' WARNING: (error) source file not found on target: nfs3 LOOKUP 'f{i}' in '10.0.0.2:/data/sub': "
+			"nfs3 error 2: no such file or directory",
+		"10.0.0.1 tcp 2049 nfs3 c0 (pending 0, sendq 0, slotq 0, closed False, reopenTask None) stats: {{'replies received': {i}}}",
+		"xcp (1235) {t} xcp: 1,234 scanned, 0 errors, 1.2 MiB in, 5s",
+		'  File "nfs3.pyx", line 289, in nfs3.Client.setattr3 (nfs3.c:5646)',
+	]
+	start = time.mktime(time.strptime('2019-11-04 13:48:20', basics.format))
+	for i in xrange(n):
+		t = time.strftime(basics.format, time.localtime(start + i / 50))
+		if i % 100000 == 0:
+			yield "xcp {} xcp: Command: verify {{}}".format(t)
+			yield "xcp {} xcp: Paths: ['10.0.0.1:/vol', '10.0.0.2:/data']".format(t)
+		yield templates[i % len(templates)].format(t=t, i=i)
+
+# The classifier as it was before the timestamp cache and the dispatch on the first word, kept for -benchmark
+# It splits every line, parses every timestamp, and tests each ignored line against the whole chain
+class BaselineEntry(Entry):
+	def __init__(self, line, i):
+		self.i = i
+		self.line = line
+		self.log = None
+		self.xcp = False
+		self.banner = False
+		self.child = None
+		self.warning = False
+		self.error = False
+		self.channel = None
+
+		fields = line.split(' ')
+		self.rest = line
+		self.head = fields[0]
+		self._fields = fields
+		if not line:
+			return
+
+		if fields[0] == 'xcp':
+			if re.match('\([0-9]+\)', fields[1]):
+				self.child = int(fields[1].lstrip('(').rstrip(')'))
+				fields = fields[1:]
+			try:
+				self.t = time.strptime(' '.join(fields[1:3]), basics.format)
+			except Exception as e:
+				print("xlog error line {}: {}: {}".format(self.i, self.line, e))
+				return
+			fields = fields[3:]
+			if fields[0] == 'xcp:' or ' '.join(fields[:2]) == 'xcp ERROR:':
+				self.xcp = True
+				fields = fields[1:]
+			self.setFields(fields)
+			if not self.xcp and ' WARNING: ' in line:
+				self.warning = Warning(self)
+				self.xcp = True
+		elif fields[0] == 'XCP':
+			self.banner = True
+		elif len(fields) > 1 and (line[:16] == 'RPC channel dump' \
+		 or ' stats: {' in line \
+		 or fields[0] == 'Build' \
+		 or ' '.join(fields[:2]) == 'pending xid' \
+		 or 'File "' in ' '.join(fields[0:2]) \
+		 or fields[1] == 'setattr3()' \
+		 or ' '.join(fields[:2]) == '(c) 2019'\
+		 or ' '.join(fields[:4]) == 'Register for a license'\
+		 or "Failed with 'socket connect" in ' '.join(fields[0:5])):
+			pass
+
+	def setFields(self, fields):
+		self._fields = fields
+		self.rest = ' '.join(fields)
+		self.head = fields[0] if fields else ''
+
+	# The epoch time was only computed for the first and last entry of each command
+	@property
+	def time(self):
+		return time.mktime(self.t)
+
+# Parses the synthetic log with the baseline classifier and then the current one, with the same LogParser
+def benchmark(n):
+	lines = list(syntheticLog(n))
+	def baseline():
+		for i, line in enumerate(lines, 1):
+			e = BaselineEntry(line.strip(), i)
+			if e.xcp and e.rest:
+				yield e
+	timestamps.cache.clear()
+	for name, entries in ('baseline', baseline()), ('current', readEntries(lines)):
+		parser = LogParser(LogInfo(None))
+		start = time.time()
+		for e in entries:
+			parser.add(e)
+		elapsed = time.time() - start
+		print("{}: parsed {} lines in {:.2f}s: {:.0f} lines/sec".format(name, len(lines), elapsed, len(lines) / max(elapsed, 1e-6)))
+
 class Runxlog(command.Runner):
 	def gRun(self, xlogCmd, catalog):
 		logInfo = LogInfo(xlogCmd.options)
+		if xlogCmd.options.chose(benchmarkOption):
+			benchmark(xlogCmd.options.get(benchmarkOption))
+			return
+
 		if xlogCmd.options.chose(logFileOption):
-			logPath = self.options.get(logFileOption)
+			paths = logPaths(self.options.get(logFileOption))
 		else:
-			logPath = repo.getXcpLogPath()
+			paths = [repo.getXcpLogPath()]
+		logPath = ', '.join(paths)
 
 		print('reading from: {}'.format(logPath))
 
@@ -333,96 +1425,116 @@ class Runxlog(command.Runner):
 		# self.log.f is usually going to be /opt/NetApp/xFiles/xcp/xcp.x1.log
 		#print('logging to: {}'.format(self.log.f))
 
-		# Create a simple Entry object for each nonempty line in the log
-
-		# If it's bigger than 50MB, let them know
-		size = os.path.getsize(logPath)
-		if size > (50<<20):
-			print("parsing log entries (this could take a while; the log file is {})...".format(basics.formatSize(size)))
-
-		with open(logPath) as f:
-			entries = [Entry(line.strip(), i) for i, line in enumerate(f.readlines(), 1) if line]
-
-		# Filter out uninteresting lines
-		entries = [e for e in entries if e.xcp and len(e.fields)]
-
-		# This is the main loop to parse all the entries and identify commands
-		# After this loop, once we have all the commands and all their entries,
-		# a few more loops through the commands are done to get some extra info
-		cmd = None
-		engineInfo = None
-
-		for e in entries:
-			if e.fields[0] == 'Command:':
-				# Example
-				# xcp 2019-11-04 18:52:02 xcp: Command: scan {-id: 'autoname_copy_2019-08-17_03.56.47.773764', -match: 'x.getPath()==1'}
-				cmd = LoggedCommand(e, logInfo)
-				engineInfo = None
-
-			elif e.fields[0] == 'Paths:':
-				# Example
-				# xcp 2019-11-04 16:37:11 xcp: Paths: ['172.20.28.50:/NS/.snapshot/xcp_presync_11012019', '172.20.28.55:/data']
-				cmd.paths = eval(''.join(e.fields[1:3]))
-
-			elif e.warning:
-				if cmd:
-					cmd.warnings.append(e.warning)
-
-			elif e.fields[0] == 'Index:':
-				# The index has the source and target (or just source for a scan-only index)
-				# Example
-				# xcp 2019-11-04 18:52:02 xcp: Index: {source: 172.20.28.50:/NS, target: 172.20.28.55:/data}
-
-				# Note that for sync and sync dry-run, there could 
-				# be a -snap option which is the latest source.  
-				# In that case this index 'source' logged here is the original baseline copy source
-				cmd.index = parseDict(' '.join(e.fields[1:]))
-
-				# The log has this 'Index:' line because either -id or -newid was used
-				# So get the id name out from the options
-				cmd.idName = cmd.cmdOptions.get('-newid') or cmd.cmdOptions['-id']
-				logInfo.indexes[cmd.idName] = cmd.index
-
-			elif e.fields[0] == 'main:' and e.fields[3] == 'runid':
-				# This is the start of a new command; its 'Command:' entry is coming up
-				# Example
-				# xcp 2019-11-04 18:52:02 main: pid 12502 runid 890747532820843
-				cmd = None
-				engineInfo = None
-
-			elif cmd and not engineInfo and ' '.join(e.fields[:2]) == 'Engine info:':
-				# When we see 'Engine info:' the first time it is the beginning of the end
-				# The log entry before it should either be the final stats line or an error
-				# This is obviously a very brittle kludgy way to determine if it failed,
-				# and it is my fault for allowing the log to be so inconsistent and messy
-				# Anyway this seems to work but certainly needs more validation
-				if cmd.entries[-1].fields[0] == 'ERROR:':
-					cmd.failure = cmd.entries[-1]
+		# The sinks need the commands in order with their final keys, so they don't work with the cache or -parallel
+		sinks = []
+		if xlogCmd.options.chose(dbOption):
+			sinks.append(DbExport(xlogCmd.options.get(dbOption)))
+		if xlogCmd.options.chose(osfixOption):
+			cmdKey = xlogCmd.get(osfixOption)
+			sinks.append(OsFix(cmdKey, xlogCmd.options.get(outOption) or '{}.osfix.sh'.format(cmdKey)))
+		timeline = None
+		if xlogCmd.options.chose(timelineOption):
+			timeline = Timeline(xlogCmd.get(timelineOption), xlogCmd.options.get(outOption))
+			sinks.append(timeline)
+		pending = None
+		if xlogCmd.options.chose(pendingOption):
+			pending = PendingReport(xlogCmd.get(pendingOption))
+			sinks.append(pending)
+		channels = bool(timeline or pending)
+
+		if len(paths) > 1 or paths[0].endswith('.gz'):
+			# If they're bigger than 50MB, let them know
+			size = sum(os.path.getsize(path) for path in paths)
+			if size > (50<<20):
+				print("parsing log entries (this could take a while; the logs are {})...".format(basics.formatSize(size)))
+			# Each log has its own parser, since a command's entries are only in its own log;
+			# they share the logInfo, so the commands get their keys in the order they started
+			parsers = [LogParser(logInfo) for path in paths]
+			for parser in parsers:
+				parser.sinks = sinks
+			for n, e in mergeEntries(paths, channels=channels):
+				parsers[n].add(e)
+		else:
+			useCache = not xlogCmd.options.chose(noCacheOption) and not sinks
+			cachePath = parseCachePath(logPath)
+
+			with open(logPath, 'rb') as f:
+				# Start from the cache, or from the beginning
+				parser, offset, lines = None, 0, 0
+				if useCache:
+					cached = loadParseCache(cachePath, f)
+					if cached:
+						parser, offset, lines = cached
+						logInfo = parser.logInfo
+						logInfo.options = xlogCmd.options
+				if not parser:
+					parser = LogParser(logInfo)
+					parser.sinks = sinks
+
+				# If it's bigger than 50MB, let them know
+				size = os.fstat(f.fileno()).st_size - offset
+				if size > (50<<20):
+					print("parsing log entries (this could take a while; the log file is {})...".format(basics.formatSize(size)))
+
+				# This is the main loop to parse the entries and identify commands
+				total = os.fstat(f.fileno()).st_size
+				ranges = []
+				if xlogCmd.options.chose(sched.parallelOption) and not sinks:
+					n = min(xlogCmd.options.get(sched.parallelOption), (total - offset) / minRangeSize)
+					ranges = splitLog(f, offset, total, n)
+				if len(ranges) > 1:
+					print("parsing {} ranges of the log in parallel".format(len(ranges)))
+					myEnd, otherEnd = sched.Tube("xlog ranges").ends
+					gate = sched.Gate(xlogCmd.options.get(sched.parallelOption), 'xlog ranges')
+					for start, end in ranges:
+						yield (gate, None)
+						ParseRange(logPath, start, end, otherEnd).leaveWhenFinished(gate)
+					if not gate.close():
+						yield
+
+					results = {}
+					while len(results) < len(ranges):
+						result = myEnd.receive()
+						if result is None:
+							result = yield
+						start, results[start] = result
+
+					parsed = 0
+					for start, end in ranges:
+						other, end, count = results[start]
+						parser.stitch(other, lines + parsed)
+						parsed += count
+					newOffset, newLines = end, lines + parsed
 				else:
-					cmd.finalStatus = cmd.entries[-1]
-				engineInfo = 1
+					reader = LineReader(f, offset)
+					for e in readEntries(reader, lines + 1, channels=channels):
+						parser.add(e)
+					newOffset, newLines = reader.offset, lines + reader.count
 
-			if cmd:
-				cmd.entries.append(e)
+				if useCache and newLines > lines:
+					saveParseCache(cachePath, f, parser, newOffset, newLines)
 
-		# Get the duration of the command
-		# getAge was written to display modification times; that's why it's called "Age";
-		# in this case we are using to show human readable command duration like "15h18m"
-		for cmd in logInfo.commands.values():
-			cmd.duration = basics.getAge(
-				datetime.datetime.fromtimestamp(time.mktime(cmd.entry.t)),
-				datetime.datetime.fromtimestamp(time.mktime(cmd.entries[-1].t))
-			)
-			cmd.checkid()
-
-		for cmd in logInfo.commands.values():
-			assert cmd.duration[0] == '+', "internal error: invalid duration calculation: {}".format(cmd.duration[0])
-			# the getAge expects negatives so it adds a + which we don't want here
-			cmd.duration = cmd.duration.strip('+')
+				# The last line if it has no newline; it is parsed after the cache is saved, so it is not in the cache
+				for e in readEntries(LineReader(f, newOffset, partial=True), newLines + 1, channels=channels):
+					parser.add(e)
+		parser.finish()
+		for sink in sinks:
+			sink.finish(logInfo)
 
 		print
 
-		if xlogCmd.options.chose(showOption):
+		reports = [report for report in (timeline, pending) if report]
+		for report in reports:
+			cmd = logInfo.commands.get(report.key)
+			if not cmd:
+				raise sched.ShortError('command {} not found in {}'.format(report.key, logPath))
+			print(cmd.fmt())
+			report.write()
+			print
+		if reports:
+			return
+
+		if xlogCmd.options.chose(showOption) or xlogCmd.options.chose(osfixOption):
 			cmdKey = xlogCmd.get(showOption) or xlogCmd.get(osfixOption)
 			cmd = logInfo.commands.get(cmdKey)
 			if not cmd:
@@ -435,16 +1547,14 @@ class Runxlog(command.Runner):
 			print("Found {} warnings".format(len(cmd.warnings)))
 			if not cmd.warnings:
 				return
-			categories = sorted({w.category for w in filter(lambda w: not w.ignore, cmd.warnings)})
-			wlists = [filter(lambda w: w.category == wt and not w.ignore, cmd.warnings) for wt in categories]
-			wcounts = [len(wl) for wl in wlists]
+			categories = sorted(cmd.warnings.counts)
 			print("warning types:")
-			for category, n in zip(categories, wcounts):
-				print("  {}: {}".format(category, n))
+			for category in categories:
+				print("  {}: {}".format(category, cmd.warnings.counts[category]))
 			print("first two of each type...")
-			for wl in wlists:
-				for w in wl[:2]:
-					print w.text
+			for category in categories:
+				for text in cmd.warnings.examples[category]:
+					print text
 
 			return
 
@@ -462,9 +1572,6 @@ class Runxlog(command.Runner):
 		for cmd in logInfo.commands.values():
 			print cmd.fmt(long=xlogCmd.options.chose(longOption))
 
- 		if 0:
-			yield
-
 desc = command.Desc(
 	"xlog",
 	[
@@ -472,6 +1579,14 @@ desc = command.Desc(
 		lineNumbersOption,
 		longOption,
 		showOption,
+		osfixOption,
+		outOption,
+		timelineOption,
+		pendingOption,
+		noCacheOption,
+		sched.parallelOption,
+		dbOption,
+		benchmarkOption,
 	],
 	"Read the log to summarize commands and errors and optionally repair targets",
 	npaths=None,